@@ -5,37 +5,176 @@ Jinja2 for templating, and SQLAlchemy for database interaction.
 """
 # Imports
 from functools import wraps
+import hashlib
 from flask import (Flask, render_template, redirect, url_for,
-                   request, jsonify, flash, make_response)
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import SQLAlchemyError
-import bleach
+                   request, flash, make_response, Markup, abort,
+                   Response, stream_with_context, has_request_context,
+                   _app_ctx_stack)
+from sqlalchemy.orm import configure_mappers, scoped_session
 from flask import session as login_session
 import random
 import string
-from oauth2client.client import (flow_from_clientsecrets,
-                                 FlowExchangeError)
-import httplib2
 import json
-import requests
-from setup import Base, User, Category, Item
-from queryhelpers import (getCategories, getCategory,
+import os
+from setup import Base, Category, Item, createSchema
+from database import (createEngine, createReplicaEngine,
+                      makeSessionFactory, setting)
+from sessions import ServerSessionInterface, sessionBackend
+from assets import serveAssets
+from search import searchItems, indexItem, unindexItem
+from bulk import FORMATS, readRows, importItems, exportItems
+from pagecache import pages, htmlKey, fragment
+from users import loginUser
+from jsonresponse import jsonResponse, compressResponse, CatalogEncoder
+from queryhelpers import (getCategories, catalogExportQuery,
+                          getCategory,
                           getItems, getCategoryItems,
-                          getItem)
+                          getCategoryItem, pageLimit, nextCursor,
+                          catalogVersion, clean,
+                          invalidateCategories,
+                          invalidateCategoryItems,
+                          adjustItemCount, repairItemCounts)
 
-# Copy your Google oauth2 credentials to client_secrets.json
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
 APPLICATION_NAME = "Danslist"
 app = Flask(__name__)
 
 # From root directory of this application,
-# run python db/setup.py to create database.
-engine = create_engine('sqlite:///catalog.db', pool_pre_ping=True)
+# run python setup.py to create database.
+# Connection settings are read from the environment, see database.py.
+engine = createEngine()
+replica_engine = createReplicaEngine()
 Base.metadata.bind = engine
-DBSession = sessionmaker(bind=engine)
-# Initializing DBSession() at beginning of each function to avoid Flask error.
+
+
+def readOnlyRequest():
+    """
+    :return:
+    True while handling a GET or HEAD request, whose queries
+    may be served by the read replica.
+    """
+    return has_request_context() and request.method in ('GET', 'HEAD')
+
+
+# DBSession() returns the same session for the whole app context,
+# so views and the helpers they call share one connection.
+DBSession = scoped_session(makeSessionFactory(engine, replica_engine,
+                                              readOnlyRequest),
+                           scopefunc=_app_ctx_stack.__ident_func__)
+
+
+def configureApp():
+    """
+    Configure the module's app from the environment. The routes are
+    registered on that one app when this module is imported, so this
+    is not a factory: every call returns the same shared app, and only
+    the first one configures it. Called once by wsgi.py, before the
+    server forks its workers, and by the development server.
+
+    CATALOG_SECRET_KEY          Flask secret key; every worker and host
+                                must share it
+    CATALOG_SESSION_PATH        SQLite file shared by every worker's
+                                sessions, see sessions.py
+    CATALOG_CLIENT_SECRETS      Google client secrets file
+                                (client_secrets.json), read on first login
+    CATALOG_INSTRUMENT          1 to time requests, see instrumentation.py
+    :return:
+    Flask app
+    """
+    if app.config.get('CATALOG_CONFIGURED'):
+        return app
+    app.secret_key = setting('CATALOG_SECRET_KEY', None)
+    if not app.secret_key:
+        app.logger.warning('CATALOG_SECRET_KEY is not set, so each '
+                           'process uses a random one.')
+        app.secret_key = os.urandom(32)
+    # The session cookie only holds an id, the data stays on the server.
+    app.session_interface = ServerSessionInterface(
+        sessionBackend(), setting('CATALOG_SESSION_TTL', 86400))
+    if not setting('CATALOG_SESSION_PATH', None):
+        app.logger.warning('CATALOG_SESSION_PATH is not set, so sessions '
+                           'are kept in this process only.')
+    if setting('CATALOG_INSTRUMENT', 0):
+        from instrumentation import instrument
+        instrument(app, [e for e in (engine, replica_engine)
+                         if e is not None])
+    # JSON bodies are compressed for clients that accept it, see
+    # jsonresponse.py. Handlers run last-registered first, so this one
+    # runs before the instrumentation's and is included in its timings.
+    app.after_request(compressResponse)
+    # Hashed, precompressed CSS and fonts, see assets.py.
+    serveAssets(app)
+    # Do the work every worker would otherwise repeat once, before
+    # the fork, so that it is shared copy-on-write.
+    configure_mappers()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    app.config['CATALOG_CONFIGURED'] = True
+    return app
+
+
+# Google client secrets, see clientSecrets.
+client_secrets = None
+
+
+def clientSecrets():
+    """
+    Read the Google client secrets on first use.
+    Copy your Google oauth2 credentials to client_secrets.json.
+    :return:
+    'web' section of the client secrets file.
+    """
+    global client_secrets
+    if client_secrets is None:
+        path = setting('CATALOG_CLIENT_SECRETS', 'client_secrets.json')
+        with open(path, 'r') as f:
+            client_secrets = json.load(f)['web']
+    return client_secrets
+
+
+def afterFork():
+    """
+    Drop the pooled connections inherited from the parent process.
+    A connection must not be shared between processes, so each worker
+    calls this once after the fork, see gunicorn.conf.py.
+    """
+    DBSession.remove()
+    for e in (engine, replica_engine):
+        if e is not None:
+            e.dispose()
+
+
+@app.cli.command('init-db')
+def initDb():
+    """
+    Create the database tables, same as python setup.py.
+    """
+    createSchema(engine)
+
+
+@app.cli.command('repair-counts')
+def repairCounts():
+    """
+    Recount every category's items, see queryhelpers.repairItemCounts.
+    """
+    session = DBSession()
+    print "Repaired %d category counts." % repairItemCounts(session)
+
+
+@app.teardown_appcontext
+def removeSession(exception=None):
+    """
+    Commit the request's session, or roll it back if the request failed,
+    then close it so its connection goes back to the pool.
+    :param exception: (Exception) error that ended the request, if any
+    """
+    try:
+        if DBSession.registry.has():
+            if exception is None:
+                DBSession.commit()
+            else:
+                DBSession.rollback()
+    finally:
+        DBSession.remove()
 
 
 def loginRequired(f):
@@ -74,50 +213,156 @@ def adminRequired(f):
     return decorated_function
 
 
+def conditionalJSON(f):
+    """
+    Answers If-None-Match with a 304 before running the view.
+    The strong ETag is derived from the catalog version and the
+    request path and query string, so any write changes every ETag.
+    :return:
+    Decorator function.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        etag = hashlib.sha1(('%s %s' % (catalogVersion(), request.full_path))
+                            .encode('utf-8')).hexdigest()
+        # Compressed responses carry the weak form of the same ETag.
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(f(*args, **kwargs))
+            # Errors are not tied to a catalog version.
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        # Clients may keep the payload but must revalidate it on each poll.
+        response.cache_control.no_cache = True
+        return response
+    return decorated_function
+
+
+def cachedPage(f):
+    """
+    Serves anonymous visitors without pending flash messages a cached
+    copy of the page, without touching the database or the templates.
+    :return:
+    Decorator function.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'username' in login_session or '_flashes' in login_session:
+            return f(*args, **kwargs)
+        key = htmlKey('page', request.full_path)
+        html = pages.get(key)
+        if html is not None:
+            return html
+        response = make_response(f(*args, **kwargs))
+        if response.status_code == 200:
+            pages.set(key, response.get_data())
+        return response
+    return decorated_function
+
+
+def pageArgs():
+    """
+    Read the keyset pagination arguments from the query string.
+    :return:
+    (after, limit) tuple for getItems/getCategoryItems.
+    """
+    after = request.args.get('after', type=int)
+    limit = pageLimit(request.args.get('limit', type=int))
+    return after, limit
+
+
+def renderSidebar(session, selected=None):
+    """
+    :param session: (DBSession) SQLAlchemy session
+    :param selected: (string) name of the highlighted category
+    :return:
+    Markup of the category sidebar, from the fragment cache.
+    """
+    return fragment('sidebar',
+                    lambda: render_template('sidebar.html',
+                                            categories=getCategories(session),
+                                            selected=selected),
+                    selected)
+
+
 @app.route('/')
 @app.route('/catalog')
+@cachedPage
 def Catalog():
     """
-    Retrieves all items from newest to oldest.
+    Retrieves a page of items from newest to oldest.
     Retrieves all categories.
     Returns Home page.
     """
     session = DBSession()
-    categories = getCategories(session)
-    items = getItems(session)
+    after, limit = pageArgs()
+
+    def renderItems():
+        items = getItems(session, after, limit)
+        return render_template('itemlist.html', items=items,
+                               next_after=nextCursor(items, limit))
     username = (login_session['username']
                 if 'username' in login_session.keys()
                 else None)
-    return render_template('catalog.html', categories=categories,
-                           username=username, items=items)
+    return render_template('catalog.html',
+                           sidebar=renderSidebar(session),
+                           item_list=fragment('items', renderItems,
+                                              None, after, limit),
+                           username=username)
+
+
+def generateCatalogJSON(session):
+    """
+    Encode the full catalog export one category and item at a time.
+    Produces the same document as
+    jsonResponse(categories=[...serialize_items])
+    without holding the whole catalog in memory.
+    :param session: (DBSession) SQLAlchemy session
+    :return:
+    Generator of JSON chunks.
+    """
+    encoder = CatalogEncoder()
+    yield encoder.start()
+    for row in catalogExportQuery().with_session(session).yield_per(1000):
+        yield encoder.row(row)
+    yield encoder.end()
 
 
 @app.route('/catalog/JSON')
+@conditionalJSON
 def CatalogJSON():
     """
       Retrieve all categories and their associated items.
+      The response is streamed as it is read from the database.
       :return:
       JSON-formatted list of categories with each
       category containing a list of items.
       """
     session = DBSession()
-    categories = getCategories(session)
-    return jsonify(categories=[r.serialize_items for r in categories])
+    return Response(stream_with_context(generateCatalogJSON(session)),
+                    mimetype='application/json')
 
 
 @app.route('/catalog/items/JSON')
+@conditionalJSON
 def CatalogItemsJSON():
     """
-      Retrieve all items in alphabetic order.
+      Retrieve a page of items from newest to oldest.
+      Accepts ?after=<id>&limit=N for keyset pagination.
       :return:
-      JSON-formatted list of items.
+      JSON-formatted list of items and the cursor for the next page.
       """
     session = DBSession()
-    items = getItems(session)
-    return jsonify(items=[r.serialize for r in items])
+    after, limit = pageArgs()
+    items = getItems(session, after, limit)
+    return jsonResponse(items=[r.serialize for r in items],
+                        next_after=nextCursor(items, limit))
 
 
 @app.route('/catalog/<string:category_name>/items')
+@cachedPage
 def CategoryItems(category_name):
     """
     View the items for a particular category.
@@ -126,33 +371,92 @@ def CategoryItems(category_name):
     HTML page of a particular category's items.
     """
     session = DBSession()
-    category = getCategory(category_name, session)
-    categories = getCategories(session)
-    items = getCategoryItems(category.id, session)
+    after, limit = pageArgs()
+
+    def renderItems():
+        category = getCategory(category_name, session)
+        items = getCategoryItems(category.id, session, after, limit)
+        return render_template('itemlist.html', items=items,
+                               category=category,
+                               next_after=nextCursor(items, limit))
     username = (login_session['username']
                 if 'username' in login_session.keys()
                 else None)
     return render_template('catalog.html',
-                           items=items,
-                           categories=categories,
-                           username=username,
-                           category=category)
+                           sidebar=renderSidebar(session, category_name),
+                           item_list=fragment('items', renderItems,
+                                              category_name, after, limit),
+                           username=username)
 
 
 @app.route('/catalog/<string:category_name>/items/JSON')
+@conditionalJSON
 def CategoryItemsJSON(category_name):
     """
-    View the items for a particular category in JSON
+    View a page of the items for a particular category in JSON.
+    Accepts ?after=<id>&limit=N for keyset pagination.
     :param category_name: string
     :return:
-    JSON-formatted category and its items.
+    JSON-formatted category, its items and the cursor for the next page.
     """
     session = DBSession()
-    category = (session.query(Category)
-                .filter(Item.category_id == Category.id)
-                .filter_by(name=bleach.clean(category_name))
-                .one())
-    return jsonify(category=category.serialize_items)
+    after, limit = pageArgs()
+    category = getCategory(category_name, session)
+    items = getCategoryItems(category.id, session, after, limit)
+    serialized = category.serialize
+    serialized['items'] = [r.serialize for r in items]
+    return jsonResponse(category=serialized,
+                        next_after=nextCursor(items, limit))
+
+
+@app.route('/catalog/search')
+def Search():
+    """
+    Search item labels and descriptions.
+    Accepts ?q=<text>&page=N&limit=N.
+    :return:
+    HTML page of matching items, best matches first.
+    """
+    session = DBSession()
+    query = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+    limit = pageLimit(request.args.get('limit', type=int))
+    # False when the database failed, shown as no results.
+    items = searchItems(query, session, page, limit) or []
+    username = (login_session['username']
+                if 'username' in login_session.keys()
+                else None)
+    item_list = Markup(render_template('itemlist.html', items=items,
+                                       query=query,
+                                       next_page=page + 1
+                                       if len(items) == limit else None))
+    return render_template('catalog.html',
+                           sidebar=renderSidebar(session),
+                           item_list=item_list,
+                           username=username,
+                           query=query)
+
+
+@app.route('/catalog/search/JSON')
+@conditionalJSON
+def SearchJSON():
+    """
+    Search item labels and descriptions in JSON.
+    Accepts ?q=<text>&page=N&limit=N.
+    :return:
+    JSON-formatted list of matching items, best matches first,
+    and the number of the next page.
+    """
+    session = DBSession()
+    query = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+    limit = pageLimit(request.args.get('limit', type=int))
+    items = searchItems(query, session, page, limit)
+    if items is False:
+        return jsonResponse(error='Search is unavailable.'), 503
+    return jsonResponse(items=[r.serialize for r in items],
+                        next_page=page + 1 if len(items) == limit
+                        else None)
 
 
 # Admin access only.
@@ -169,6 +473,7 @@ def Categories():
 
 
 @app.route('/categories/JSON')
+@conditionalJSON
 def CategoriesJSON():
     """
     View all categories in JSON
@@ -177,7 +482,7 @@ def CategoriesJSON():
     """
     session = DBSession()
     categories = getCategories(session)
-    return jsonify(categories=[r.serialize for r in categories])
+    return jsonResponse(categories=[r.serialize for r in categories])
 
 
 @app.route('/categories/new', methods=['GET', 'POST'])
@@ -193,10 +498,11 @@ def newCategory():
         return render_template('newcategory.html')
     if request.method == 'POST':
         new_category = Category(
-            name=bleach.clean(request.form['name'])
+            name=clean(request.form['name'])
         )
         session.add(new_category)
         session.commit()
+        invalidateCategories()
         flash(new_category.label + " created.")
         return redirect(url_for('Categories'))
 
@@ -218,10 +524,11 @@ def editCategory(category_name):
     if request.method == 'GET':
         return render_template('editcategory.html', category=category)
     if request.method == 'POST':
-        category.label = bleach.clean(request.form['name'])
+        category.label = clean(request.form['name'])
         category.name = category.label.lower()
         session.add(category)
         session.commit()
+        invalidateCategories()
         flash(category.label + " updated.")
         return redirect(url_for('Categories'))
 
@@ -246,6 +553,7 @@ def deleteCategory(category_name):
     if request.method == 'POST':
         session.delete(category)
         session.commit()
+        invalidateCategories()
         flash(category.label + " deleted.")
         return redirect(url_for('Categories'))
 
@@ -272,9 +580,9 @@ def newItem(category_name=None):
                                category=category, categories=categories)
     if request.method == 'POST':
         new_item = Item(
-            label=bleach.clean(request.form['name']),
-            description=bleach.clean(request.form['description']),
-            category_id=bleach.clean(request.form['category']),
+            label=clean(request.form['name']),
+            description=clean(request.form['description']),
+            category_id=formCategoryId(categories),
             user_id=login_session['user_id']
         )
         new_item = addItem(new_item, session)
@@ -285,6 +593,48 @@ def newItem(category_name=None):
         return redirect(url_for('Catalog'))
 
 
+@app.route('/catalog/items/bulk', methods=['GET', 'POST'])
+@loginRequired
+def bulkItems():
+    """
+    Import items from, or export items to, CSV or NDJSON.
+    POST a CSV file with a category,label,description header, or one
+    JSON object per line; set ?format=csv or a text/csv Content-Type.
+    GET streams every item in the same format.
+    :return:
+    JSON-formatted import report, or the streamed export.
+    """
+    session = DBSession()
+    fmt = request.args.get('format')
+    if request.method == 'GET':
+        fmt = fmt if fmt in FORMATS else 'ndjson'
+        return Response(stream_with_context(exportItems(session, fmt)),
+                        mimetype='text/csv' if fmt == 'csv'
+                        else 'application/x-ndjson')
+    if fmt not in FORMATS:
+        fmt = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+    result = importItems(readRows(request.stream, fmt), session,
+                         login_session['user_id'])
+    return jsonResponse(**result)
+
+
+def formCategoryId(categories):
+    """
+    Read the category chosen in an item form.
+    :param categories: (list) categories the form offered
+    :return:
+    integer Category.id, or a 400 response when the posted value is
+    not the id of one of categories.
+    """
+    try:
+        category_id = int(request.form['category'])
+    except ValueError:
+        abort(400)
+    if category_id not in [c.id for c in categories]:
+        abort(400)
+    return category_id
+
+
 def addItem(new_item, session):
     """
     Add item to database.
@@ -296,12 +646,18 @@ def addItem(new_item, session):
     new_item.name = new_item.label.lower()
     if len(new_item.name) < 1:
         raise ValueError('Name cannot be empty.')
+    if new_item.id is None:
+        adjustItemCount(new_item.category_id, 1, session)
     session.add(new_item)
+    session.flush()
+    indexItem(new_item, session)
     session.commit()
+    invalidateCategoryItems(new_item.category_id)
     return new_item
 
 
 @app.route('/catalog/<string:category_name>/item/<string:item_name>')
+@cachedPage
 def viewItem(category_name, item_name):
     """
     View a particular item from a category.
@@ -311,19 +667,33 @@ def viewItem(category_name, item_name):
     HTML page
     """
     session = DBSession()
-    category = getCategory(category_name, session)
-    item = getItem(category.id, item_name, session)
+
+    def renderItem():
+        category, item = getCategoryItem(category_name, item_name, session)
+        # Raised before anything is cached for a made-up URL.
+        if not item:
+            abort(404)
+        return render_template('itemdetail.html', item=item)
     username = None
     user_id = None
+    category = None
+    item = None
     if 'username' in login_session:
         username = login_session['username']
         user_id = login_session['user_id']
+        # The owner's edit links need the item itself.
+        category, item = getCategoryItem(category_name, item_name, session)
+        if not item:
+            abort(404)
     return render_template('viewitem.html',
+                           item_detail=fragment('item', renderItem,
+                                                category_name, item_name),
                            item=item, category=category,
                            username=username, user_id=user_id)
 
 
 @app.route('/catalog/<string:category_name>/item/<string:item_name>/JSON')
+@conditionalJSON
 def viewItemJSON(category_name, item_name):
     """
     View a particular item from a category in JSON
@@ -333,9 +703,10 @@ def viewItemJSON(category_name, item_name):
     JSON-formatted http response
     """
     session = DBSession()
-    category = getCategory(category_name, session)
-    item = getItem(category.id, item_name, session)
-    return jsonify(item=item.serialize)
+    category, item = getCategoryItem(category_name, item_name, session)
+    if not item:
+        abort(404)
+    return jsonResponse(item=item.serialize)
 
 
 @app.route('/catalog/<string:category_name>/item/<string:item_name>/edit',
@@ -352,19 +723,27 @@ def editItem(category_name, item_name):
     if 'user_id' not in login_session:
         return redirect(url_for('showLogin'))
     session = DBSession()
-    category = getCategory(category_name, session)
-    item = getItem(category.id, item_name, session)
+    category, item = getCategoryItem(category_name, item_name, session)
+    if not item:
+        abort(404)
     if login_session['user_id'] != item.user_id:
         return "You don't have access to this item."
-    categories = session.query(Category).order_by(Category.name).all()
+    categories = getCategories(session)
     if request.method == 'GET':
         return render_template('edititem.html', category=category,
                                categories=categories, item=item)
     if request.method == 'POST':
-        item.label = bleach.clean(request.form['name'])
-        item.description = bleach.clean(request.form['description'])
-        item.category_id = bleach.clean(request.form['category'])
+        # Checked first: the request's session commits even on a 400.
+        category_id = formCategoryId(categories)
+        item.label = clean(request.form['name'])
+        item.description = clean(request.form['description'])
+        item.category_id = category_id
+        if item.category_id != category.id:
+            adjustItemCount(category.id, -1, session)
+            adjustItemCount(item.category_id, 1, session)
         item = addItem(item, session)
+        # The item may have moved out of its previous category.
+        invalidateCategoryItems(category.id)
         flash(item.label + " updated.")
         return redirect(url_for('CategoryItems', category_name=category.name))
 
@@ -381,19 +760,23 @@ def deleteItem(category_name, item_name):
     HTML page or redirect
     """
     session = DBSession()
-    category = getCategory(category_name, session)
-    item = getItem(category.id, item_name, session)
+    category, item = getCategoryItem(category_name, item_name, session)
+    if not item:
+        abort(404)
     if login_session['user_id'] != item.user_id:
         return "You don't have access to this item."
     if request.method == 'GET':
         return render_template('deleteitem.html',
                                category=category, item=item)
     if request.method == 'POST':
+        unindexItem(item.id, session)
+        adjustItemCount(item.category_id, -1, session)
         session.delete(item)
         session.commit()
+        invalidateCategoryItems(item.category_id)
         flash(item.label + " deleted.")
         return redirect(url_for('CategoryItems',
-                                ategory_name=category.name))
+                                category_name=category.name))
 
 
 @app.route('/login')
@@ -405,7 +788,8 @@ def showLogin():
     state = ''.join(random.choice(string.ascii_uppercase + string.digits)
                     for x in xrange(32))
     login_session['state'] = state
-    return render_template('login.html', STATE=state)
+    return render_template('login.html', STATE=state,
+                           CLIENT_ID=clientSecrets()['client_id'])
 
 
 @app.route('/gconnect', methods=['POST'])
@@ -416,30 +800,31 @@ def gconnect():
     :return:
     "Done!"
     """
-    # Validate state token
-    if request.args.get('state') != login_session['state']:
+    # The OAuth libraries are only imported once someone logs in.
+    from googleauth import OAuthError, exchangeCode, fetchTokenAndProfile
+    # Validate state token. A session without one cannot log in.
+    state = login_session.get('state')
+    if not state or request.args.get('state') != state:
         response = make_response(json.dumps('Invalid state parameter.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
     # Obtain authorization code
     code = request.data
     try:
-        # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
-    except FlowExchangeError:
+        # Upgrade the authorization code into an access token
+        access_token, gplus_id = exchangeCode(code, clientSecrets())
+    except OAuthError:
         response = make_response(
             json.dumps('Failed to upgrade the authorization code.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    # Check that the access token is valid.
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
+    # Check that the access token is valid,
+    # fetching the user info at the same time.
+    try:
+        result, data = fetchTokenAndProfile(access_token, gplus_id)
+    except OAuthError as e:
+        result = {'error': str(e)}
     # If there was an error in the access token info, abort.
     if result.get('error') is not None:
         response = make_response(json.dumps(result.get('error')), 500)
@@ -447,7 +832,6 @@ def gconnect():
         return response
 
     # Verify that the access token is used for the intended user.
-    gplus_id = credentials.id_token['sub']
     if result['user_id'] != gplus_id:
         response = make_response(
             json.dumps("Token's user ID doesn't match given user ID."), 401)
@@ -455,7 +839,7 @@ def gconnect():
         return response
 
     # Verify that the access token is valid for this app.
-    if result['issued_to'] != CLIENT_ID:
+    if result['issued_to'] != clientSecrets()['client_id']:
         response = make_response(
             json.dumps("Token's client ID does not match app's."), 401)
         print "Token's client ID does not match app's."
@@ -470,29 +854,21 @@ def gconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
 
+    # Start a new session id, so one set before the login is useless.
+    app.session_interface.regenerate(login_session)
     # Store the access token in the session for later use.
-    login_session['access_token'] = credentials.access_token
+    login_session['access_token'] = access_token
     login_session['gplus_id'] = gplus_id
 
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
-
     login_session['provider'] = 'google'
     login_session['username'] = data['name']
     login_session['email'] = data['email']
 
-    # Check if user exists.
-    user_id = getUserId(login_session['email'])
-    # If not, create User.
-    if user_id is None:
-        user_id = createUser(login_session)
-    login_session['user_id'] = user_id
-    userinfo = getUserInfo(user_id)
-    login_session['is_admin'] = userinfo.is_admin
+    # Find the user, creating it on first login.
+    user = loginUser(login_session['email'], login_session['username'],
+                     DBSession())
+    login_session['user_id'] = user['id']
+    login_session['is_admin'] = user['is_admin']
     output = 'Done!'
     flash("you are now logged in as %s" % login_session['username'])
     return output
@@ -516,6 +892,9 @@ def disconnect():
         del login_session['email']
         del login_session['user_id']
         del login_session['provider']
+        login_session.pop('is_admin', None)
+        # Ends the session in every worker, not just this cookie.
+        app.session_interface.regenerate(login_session)
         flash("You have successfully been logged out.")
         return redirect(url_for('Catalog'))
     else:
@@ -537,69 +916,20 @@ def gdisconnect():
             json.dumps('Current user not connected.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' % access_token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
-    if result['status'] == '200':
-        response = make_response(json.dumps('Successfully disconnected.'), 200)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-    else:
-        response = make_response(
-            json.dumps('Failed to revoke token for given user.', 400)
-        )
-        response.headers['Content-Type'] = 'application/json'
-        return response
-
-
-def createUser(login_session):
-    """
-    Create a new user in database table 'user'
-    :param login_session: (DBSession) login_session
-    :return:
-    User.id integer from newly created user row.
-    """
-    session = DBSession()
-    newUser = User(email=login_session['email'])
-    session.add(newUser)
-    session.commit()
-    user = session.query(User).filter_by(email=login_session['email']).one()
-    return user.id
-
-
-def getUserId(email):
-    """
-    Retrieve an existing user id using an email address
-    :param email: (string)
-    :return:
-    User.id integer
-    """
-    session = DBSession()
-    try:
-        user = session.query(User).filter_by(email=email).one()
-        return user.id
-    except SQLAlchemyError:
-        return None
-
-
-def getUserInfo(id):
-    """
-    Retrieve an existing user's data.
-    :param id: (integer) User.id
-    :return:
-    'user' row data
-    """
-    session = DBSession()
-    try:
-        user = session.query(User).filter_by(id=id).one()
-        return user
-    except SQLAlchemyError:
-        return None
+    # Revoke in the background rather than wait on Google.
+    from googleauth import revokeToken
+    revokeToken(access_token)
+    response = make_response(json.dumps('Successfully disconnected.'), 200)
+    response.headers['Content-Type'] = 'application/json'
+    return response
 
 
 if __name__ == '__main__':
-    app.secret_key = ''.join(random.choice(
-        string.ascii_uppercase + string.digits) for x in xrange(32))
+    # Development server only, production servers load wsgi.py and
+    # build the assets when deploying.
+    import assets
+    assets.build()
+    configureApp()
     app.debug = True
     app.run(host='0.0.0.0', port=5000)
     # Uncomment for https
@@ -0,0 +1,264 @@
+"""
+Read-only ASGI tier for the JSON routes of api.py.
+Each request waits on an async SQLite driver (aiosqlite) instead of
+holding a worker thread, so one process can keep many slow reads in
+flight. The queries come from queryhelpers and the payloads are
+encoded by jsonresponse, so every body is identical to the Flask
+route's. Writes, HTML pages and logins stay on the Flask app.
+Needs Python 3.7+ with starlette and aiosqlite:
+
+    uvicorn asgi:app --workers 4
+
+Reads go to CATALOG_REPLICA_URL when it is set, and to
+CATALOG_DATABASE_URL otherwise; both must be SQLite files. Responses
+carry no ETag, since the catalog version lives in the Flask workers'
+cache.
+
+CATALOG_ASYNC_POOL_SIZE     connections opened per process (10)
+"""
+import asyncio
+import contextlib
+import aiosqlite
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.engine.url import make_url
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from database import DEFAULT_URL, setting, sqlitePragmaStatements
+from jsonresponse import (COMPRESS_MIN_BYTES, CatalogEncoder, brotli,
+                          compress, dumps)
+from queryhelpers import (CategoryRecord, categoriesQuery, categoryQuery,
+                          itemQuery, itemsQuery, catalogExportQuery,
+                          itemRecords, nextCursor, pageLimit)
+
+DIALECT = sqlite.dialect()
+
+
+def compileQuery(query):
+    """
+    :param query: (Query) built without a session by queryhelpers
+    :return:
+    (SQL string, list of parameters) for the sqlite3 driver.
+    """
+    compiled = query.statement.compile(dialect=DIALECT)
+    return compiled.string, [compiled.params[name]
+                             for name in compiled.positiontup]
+
+
+def databasePath():
+    """
+    :return:
+    path of the SQLite file to read from.
+    """
+    url = make_url(setting('CATALOG_REPLICA_URL', None) or
+                   setting('CATALOG_DATABASE_URL', DEFAULT_URL))
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '',
+                                                               ':memory:'):
+        raise ValueError('asgi.py only reads from SQLite files, not %s'
+                         % url)
+    return url.database
+
+
+class ConnectionPool(object):
+    """
+    Fixed set of aiosqlite connections shared by the requests of one
+    process. Each connection runs its queries on its own thread.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.idle = None
+
+    async def open(self):
+        self.idle = asyncio.Queue()
+        for n in range(self.size):
+            connection = await aiosqlite.connect(self.path)
+            for statement in sqlitePragmaStatements():
+                await connection.execute(statement)
+            self.idle.put_nowait(connection)
+
+    async def close(self):
+        while not self.idle.empty():
+            await self.idle.get_nowait().close()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        connection = await self.idle.get()
+        try:
+            yield connection
+        finally:
+            self.idle.put_nowait(connection)
+
+    async def batches(self, query, batch_size=1000):
+        """
+        :param query: (Query) built without a session by queryhelpers
+        :param batch_size: (integer) number of rows fetched at a time
+        :return:
+        Async generator of lists of rows.
+        """
+        sql, params = compileQuery(query)
+        async with self.connection() as connection:
+            async with connection.execute(sql, params) as cursor:
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        return
+                    yield rows
+
+    async def all(self, query):
+        """
+        :param query: (Query) built without a session by queryhelpers
+        :return:
+        list of every row.
+        """
+        rows = []
+        async for batch in self.batches(query):
+            rows.extend(batch)
+        return rows
+
+
+pool = ConnectionPool(databasePath(), setting('CATALOG_ASYNC_POOL_SIZE', 10))
+
+
+def acceptedEncoding(request):
+    """
+    :param request: (Request)
+    :return:
+    'br' or 'gzip' when the client accepts it, as compressResponse picks.
+    """
+    accepted = {}
+    for part in request.headers.get('accept-encoding', '').split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    if brotli is not None and accepted.get('br', 0) > 0:
+        return 'br'
+    if accepted.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+
+def jsonResponse(request, status_code=200, **kwargs):
+    """
+    Same body and compression as jsonresponse.jsonResponse followed by
+    compressResponse in the Flask app.
+    :param request: (Request)
+    :return:
+    application/json Response
+    """
+    data = dumps(kwargs)
+    headers = {}
+    if COMPRESS_MIN_BYTES and status_code == 200:
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = acceptedEncoding(request)
+        if encoding and len(data) >= COMPRESS_MIN_BYTES:
+            data = compress(data, encoding)
+            headers['Content-Encoding'] = encoding
+    return Response(data, status_code, headers,
+                    media_type='application/json')
+
+
+def notFound():
+    return Response(dumps('Not found.'), 404,
+                    media_type='application/json')
+
+
+def pageArgs(request):
+    """
+    Read the keyset pagination arguments like api.pageArgs.
+    :param request: (Request)
+    :return:
+    (after, limit) tuple for queryhelpers.itemsQuery.
+    """
+    def intArg(name):
+        try:
+            return int(request.query_params[name])
+        except (KeyError, ValueError):
+            return None
+    return intArg('after'), pageLimit(intArg('limit'))
+
+
+async def CatalogJSON(request):
+    """
+    Stream all categories and their items, as api.CatalogJSON.
+    """
+    async def chunks():
+        encoder = CatalogEncoder()
+        yield encoder.start()
+        async for rows in pool.batches(catalogExportQuery()):
+            yield b''.join(encoder.row(row) for row in rows)
+        yield encoder.end()
+    return StreamingResponse(chunks(), media_type='application/json')
+
+
+async def CatalogItemsJSON(request):
+    """
+    A page of items from newest to oldest, as api.CatalogItemsJSON.
+    """
+    after, limit = pageArgs(request)
+    items = itemRecords(await pool.all(itemsQuery(None, after, limit)))
+    return jsonResponse(request, items=[r.serialize for r in items],
+                        next_after=nextCursor(items, limit))
+
+
+async def CategoryItemsJSON(request):
+    """
+    A page of a category's items, as api.CategoryItemsJSON.
+    """
+    after, limit = pageArgs(request)
+    rows = await pool.all(categoryQuery(
+        request.path_params['category_name']))
+    if not rows:
+        return notFound()
+    category = CategoryRecord(*rows[0])
+    items = itemRecords(await pool.all(itemsQuery(category.id, after,
+                                                  limit)))
+    serialized = category.serialize
+    serialized['items'] = [r.serialize for r in items]
+    return jsonResponse(request, category=serialized,
+                        next_after=nextCursor(items, limit))
+
+
+async def viewItemJSON(request):
+    """
+    One item, found with a single joined query, as api.viewItemJSON.
+    """
+    rows = await pool.all(itemQuery(request.path_params['category_name'],
+                                    request.path_params['item_name']))
+    if not rows:
+        return notFound()
+    return jsonResponse(request, item=itemRecords(rows)[0].serialize)
+
+
+async def CategoriesJSON(request):
+    """
+    Every category, as api.CategoriesJSON.
+    """
+    categories = [CategoryRecord(*row)
+                  for row in await pool.all(categoriesQuery())]
+    return jsonResponse(request,
+                        categories=[r.serialize for r in categories])
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await pool.open()
+    try:
+        yield
+    finally:
+        await pool.close()
+
+
+app = Starlette(routes=[
+    Route('/catalog/JSON', CatalogJSON),
+    Route('/catalog/items/JSON', CatalogItemsJSON),
+    Route('/catalog/{category_name}/items/JSON', CategoryItemsJSON),
+    Route('/catalog/{category_name}/item/{item_name}/JSON', viewItemJSON),
+    Route('/categories/JSON', CategoriesJSON),
+], lifespan=lifespan)
@@ -0,0 +1,264 @@
+"""
+Static asset pipeline. The stylesheets in static/ are minified and
+concatenated into one file named after a hash of its content, together
+with the fonts in assets/fonts/, subset to the characters the site uses
+when fontTools is installed. Every file gets precompressed .gz and,
+with brotli installed, .br variants.
+
+Templates keep calling url_for('static', filename='app.css'); once
+serveAssets is set up it returns the hashed name under /assets/, which
+is served with Cache-Control: immutable and the best precompressed
+variant the client accepts.
+
+Usage:
+    python assets.py
+
+Run it when deploying, before the app starts: serveAssets only reads
+the manifest of the last build, and logs a warning when there is none
+or the stylesheets or fonts have changed since. Files of earlier builds
+are left in place, so workers still running the previous release can
+serve them. Fonts missing from assets/fonts/ are loaded from Google
+Fonts instead, see external_fonts.
+"""
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+from flask import abort, request, send_file, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT, 'static')
+FONT_DIR = os.path.join(ROOT, 'assets', 'fonts')
+BUILD_DIR = os.path.join(STATIC_DIR, 'build')
+MANIFEST = os.path.join(BUILD_DIR, 'manifest.json')
+
+# Concatenated in this order into app.css.
+STYLESHEETS = ('main.css', 'responsive.css')
+# Font family name -> source file in FONT_DIR.
+FONTS = {'Skranji': 'Skranji-Regular.ttf'}
+# Printable ASCII and typographic punctuation.
+FONT_UNICODES = list(range(0x20, 0x7f)) + [0xa0, 0x2013, 0x2014, 0x2018,
+                                           0x2019, 0x201c, 0x201d, 0x2026]
+FONT_FORMATS = {'.woff2': 'woff2', '.woff': 'woff', '.ttf': 'truetype',
+                '.otf': 'opentype'}
+MAX_AGE = 31536000
+
+for extension, fmt in FONT_FORMATS.items():
+    mimetypes.add_type('font/' + ('ttf' if fmt == 'truetype' else
+                                  'otf' if fmt == 'opentype' else fmt),
+                       extension)
+
+# Logical name -> hashed file name in BUILD_DIR, see loadManifest.
+manifest = {}
+# Families in FONTS without a file in FONT_DIR, linked from Google Fonts
+# by header.html until they are copied there.
+external_fonts = []
+
+
+def minifyCss(css):
+    """
+    :param css: (string) stylesheet
+    :return:
+    css without comments and optional whitespace
+    """
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};:,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def hashedName(name, data):
+    """
+    :param name: (string) e.g. 'app.css'
+    :param data: (bytes) file content
+    :return:
+    name with a hash of data before its extension, e.g. app.1a2b3c4d5e.css
+    """
+    stem, extension = os.path.splitext(name)
+    return '%s.%s%s' % (stem, hashlib.sha1(data).hexdigest()[:10], extension)
+
+
+def writeAsset(name, data, build_dir):
+    """
+    Write data under its hashed name, with precompressed variants.
+    :return:
+    hashed file name
+    """
+    filename = hashedName(name, data)
+    path = os.path.join(build_dir, filename)
+    with open(path, 'wb') as f:
+        f.write(data)
+    buf = io.BytesIO()
+    # mtime=0 so that rebuilding the same content gives the same bytes.
+    with gzip.GzipFile(filename='', fileobj=buf, mode='wb',
+                       compresslevel=9, mtime=0) as f:
+        f.write(data)
+    with open(path + '.gz', 'wb') as f:
+        f.write(buf.getvalue())
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+    return filename
+
+
+def subsetFont(path):
+    """
+    :param path: (string) TrueType/OpenType/WOFF font file
+    :return:
+    (bytes, extension) of the font subset to FONT_UNICODES as WOFF2, or
+    the file unchanged when fontTools (and brotli, for WOFF2) is missing.
+    """
+    try:
+        from fontTools import subset
+    except ImportError:
+        with open(path, 'rb') as f:
+            return f.read(), os.path.splitext(path)[1]
+    options = subset.Options()
+    options.flavor = 'woff2' if brotli is not None else 'woff'
+    font = subset.load_font(path, options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=FONT_UNICODES)
+    subsetter.subset(font)
+    buf = io.BytesIO()
+    subset.save_font(font, buf, options)
+    return buf.getvalue(), '.' + options.flavor
+
+
+def sourceHash(font_dir=FONT_DIR):
+    """
+    :param font_dir: (string) directory of the FONTS files
+    :return:
+    hash of the stylesheets and fonts a build is made from.
+    """
+    digest = hashlib.sha1()
+    paths = [os.path.join(STATIC_DIR, name) for name in STYLESHEETS]
+    paths += [os.path.join(font_dir, source)
+              for family, source in sorted(FONTS.items())]
+    for path in paths:
+        if os.path.exists(path):
+            digest.update(os.path.basename(path).encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha1(f.read()).digest())
+    return digest.hexdigest()
+
+
+def build(build_dir=BUILD_DIR, font_dir=FONT_DIR):
+    """
+    Build every asset into build_dir and write its manifest, with the
+    sourceHash it was built from and the fonts that were missing.
+    :return:
+    manifest dictionary of logical name -> hashed file name.
+    """
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+    built = {}
+    faces = []
+    missing = []
+    for family, source in sorted(FONTS.items()):
+        path = os.path.join(font_dir, source)
+        if not os.path.exists(path):
+            missing.append(family)
+            continue
+        data, extension = subsetFont(path)
+        name = os.path.splitext(source)[0] + extension
+        built[name] = writeAsset(name, data, build_dir)
+        # swap: text is painted in the fallback font until this loads.
+        faces.append("@font-face{font-family:'%s';font-style:normal;"
+                     "font-weight:400;font-display:swap;"
+                     "src:url(%s) format('%s')}"
+                     % (family, built[name], FONT_FORMATS[extension]))
+    css = []
+    for name in STYLESHEETS:
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            css.append(minifyCss(f.read().decode('utf-8')))
+    built['app.css'] = writeAsset(
+        'app.css', ''.join(faces + css).encode('utf-8'), build_dir)
+    # Renamed into place, so a starting app never reads half of it.
+    path = os.path.join(build_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'files': built, 'sources': sourceHash(font_dir),
+                   'external_fonts': missing}, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+    return built
+
+
+def loadManifest():
+    """
+    Read the manifest written by the last build. Nothing is built here,
+    see build.
+    :return:
+    True when the build is made from the current stylesheets and fonts.
+    """
+    global manifest, external_fonts
+    if not os.path.exists(MANIFEST):
+        manifest, external_fonts = {}, []
+        return False
+    with open(MANIFEST) as f:
+        data = json.load(f)
+    manifest = data['files']
+    external_fonts = data['external_fonts']
+    return data['sources'] == sourceHash()
+
+
+def assetUrlFor(endpoint, **values):
+    """
+    url_for that sends built static files to their hashed names.
+    """
+    if endpoint == 'static' and values.get('filename') in manifest:
+        return url_for('asset', filename=manifest[values.pop('filename')],
+                       **values)
+    return url_for(endpoint, **values)
+
+
+def serveAsset(filename):
+    """
+    Serve a built file, precompressed if the client accepts it.
+    Its name changes with its content, so it may be cached forever.
+    """
+    if filename not in manifest.values():
+        abort(404)
+    path = os.path.join(BUILD_DIR, filename)
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if (request.accept_encodings[candidate] > 0 and
+                os.path.exists(path + suffix)):
+            encoding = candidate
+            path += suffix
+            break
+    mimetype = (mimetypes.guess_type(filename)[0] or
+                'application/octet-stream')
+    response = send_file(path, mimetype=mimetype, conditional=True,
+                         cache_timeout=MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = ('public, max-age=%d, immutable'
+                                         % MAX_AGE)
+    return response
+
+
+def serveAssets(app):
+    """
+    Serve the built assets at /assets/ and make the templates' url_for
+    link to them.
+    :param app: (Flask) application
+    """
+    if not loadManifest():
+        app.logger.warning('static/build is missing or out of date, '
+                           'run python assets.py.')
+    app.add_url_rule('/assets/<path:filename>', 'asset', serveAsset)
+    app.jinja_env.globals['url_for'] = assetUrlFor
+    app.jinja_env.globals['external_fonts'] = external_fonts
+
+
+if __name__ == '__main__':
+    for name, filename in sorted(build().items()):
+        print "%s -> static/build/%s" % (name, filename)
@@ -0,0 +1,4 @@
+"""
+Benchmarks for Danslist. Run them from the repository root,
+e.g. python -m benchmarks.lookups
+"""
@@ -0,0 +1,181 @@
+"""
+Concurrent-connection throughput of the JSON routes, served by the
+Flask app and by the async tier in asgi.py.
+Seeds a synthetic catalog, starts both servers on it, checks that every
+route returns the same body from each, then holds --connections
+keep-alive connections open against each server and reports p50/p99
+latency and requests per second per route.
+
+    python -m benchmarks.asyncapi --items 100000 --connections 64 \\
+        --asgi-python python3
+
+The Flask app runs under --flask-python on werkzeug's threaded server,
+one thread per connection; asgi.py runs under --asgi-python (3.7+)
+with uvicorn. Both default to this interpreter.
+"""
+import argparse
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+from benchmarks.seed import createSeededDatabase
+from benchmarks.routes import summarize
+
+FLASK_SERVER = ('import api\n'
+                'from werkzeug.serving import run_simple\n'
+                'run_simple("127.0.0.1", %d, api.configureApp(),\n'
+                '           threaded=True)')
+
+
+def jsonPaths(names):
+    """
+    :param names: (dictionary) seeded names from createSeededDatabase
+    :return:
+    List of (route name, path) pairs served by both tiers.
+    """
+    category = names['categories'][0]
+    item = names['items'][0]
+    return [
+        ('catalog json', '/catalog/JSON'),
+        ('items json', '/catalog/items/JSON'),
+        ('items json page 2',
+         '/catalog/items/JSON?after=%d' % (len(names['items']) // 2)),
+        ('category items json', '/catalog/%s/items/JSON' % category),
+        ('view item json', '/catalog/%s/item/%s/JSON' % (category, item)),
+        ('categories json', '/categories/JSON'),
+    ]
+
+
+def startServer(command, port, env):
+    """
+    Start a server and wait until it answers.
+    :return:
+    Popen of the server process.
+    """
+    # A file rather than a pipe, which would fill up with request logs.
+    log = tempfile.TemporaryFile()
+    process = subprocess.Popen(command, env=env, stdout=log,
+                               stderr=subprocess.STDOUT)
+    for n in range(100):
+        try:
+            fetch(httplib.HTTPConnection('127.0.0.1', port),
+                  '/categories/JSON')
+            return process
+        except (IOError, OSError, httplib.HTTPException):
+            if process.poll() is not None:
+                log.seek(0)
+                raise RuntimeError('%s exited:\n%s' % (
+                    ' '.join(command), log.read()))
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('%s did not start' % ' '.join(command))
+
+
+def fetch(connection, path):
+    """
+    :return:
+    (status, body) of a GET over connection.
+    """
+    connection.request('GET', path.replace(' ', '%20'))
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def runLoad(port, path, requests, connections):
+    """
+    Request path requests times over connections concurrent keep-alive
+    connections.
+    :return:
+    summary dictionary, see benchmarks.routes.summarize.
+    """
+    latencies = []
+    errors = []
+    remaining = itertools.count()
+
+    def worker():
+        connection = httplib.HTTPConnection('127.0.0.1', port)
+        while next(remaining) < requests:
+            start = time.time()
+            try:
+                status, body = fetch(connection, path)
+            except (IOError, OSError, httplib.HTTPException) as e:
+                errors.append('%s: %s' % (path, e))
+                connection.close()
+                continue
+            latencies.append(time.time() - start)
+            if status != 200:
+                errors.append('%s returned %d' % (path, status))
+        connection.close()
+    started = time.time()
+    workers = [threading.Thread(target=worker) for n in range(connections)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    if errors:
+        raise RuntimeError(errors[0])
+    return summarize(latencies, time.time() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per route and server')
+    parser.add_argument('--connections', type=int, default=32)
+    parser.add_argument('--flask-python', default=sys.executable)
+    parser.add_argument('--asgi-python', default=sys.executable)
+    parser.add_argument('--flask-port', type=int, default=8101)
+    parser.add_argument('--asgi-port', type=int, default=8102)
+    args = parser.parse_args()
+
+    url, engine, names = createSeededDatabase(args.categories, args.items)
+    env = dict(os.environ, CATALOG_DATABASE_URL=url,
+               CATALOG_COMPRESS_MIN_BYTES='0')
+    servers = {
+        'flask': (args.flask_port, [args.flask_python, '-c',
+                                    FLASK_SERVER % args.flask_port]),
+        'asgi': (args.asgi_port, [args.asgi_python, '-m', 'uvicorn',
+                                  'asgi:app', '--no-access-log',
+                                  '--port', str(args.asgi_port)]),
+    }
+    processes = []
+    try:
+        for name in sorted(servers):
+            port, command = servers[name]
+            processes.append(startServer(command, port, env))
+        paths = jsonPaths(names)
+        for route, path in paths:
+            bodies = [fetch(httplib.HTTPConnection('127.0.0.1', port),
+                            path)[1]
+                      for port, command in servers.values()]
+            if bodies[0] != bodies[1]:
+                raise RuntimeError('%s differs between the servers' % path)
+        print('%-22s %10s %10s %10s | %10s %10s %10s' % (
+            'route', 'flask p50', 'flask p99', 'req/s',
+            'asgi p50', 'asgi p99', 'req/s'))
+        for route, path in paths:
+            results = dict((name, runLoad(port, path, args.requests,
+                                          args.connections))
+                           for name, (port, command) in servers.items())
+            print('%-22s %10.2f %10.2f %10.1f | %10.2f %10.2f %10.1f' % (
+                route, results['flask']['p50_ms'],
+                results['flask']['p99_ms'], results['flask']['rps'],
+                results['asgi']['p50_ms'], results['asgi']['p99_ms'],
+                results['asgi']['rps']))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
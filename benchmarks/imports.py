@@ -0,0 +1,101 @@
+"""
+Cold-start cost of importing a module, which every worker and every
+test run pays before its first request. Each run imports the module in
+a fresh interpreter; on Python 3.7+ the slowest imports are listed
+from python -X importtime.
+
+    python -m benchmarks.imports [--module api] [--runs 10]
+    python -m benchmarks.imports --save-baseline imports.json
+    python -m benchmarks.imports --baseline imports.json
+
+With --baseline the run exits non-zero when the median import time
+grew beyond --tolerance.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+def importOnce(module):
+    """
+    :param module: (string) module name
+    :return:
+    (seconds, stderr) of one import in a new interpreter.
+    """
+    command = [sys.executable]
+    if sys.version_info >= (3, 7):
+        command += ['-X', 'importtime']
+    command += ['-c', 'import %s' % module]
+    start = time.time()
+    process = subprocess.Popen(command, stderr=subprocess.PIPE,
+                               cwd=os.getcwd())
+    stderr = process.communicate()[1].decode('utf-8', 'replace')
+    seconds = time.time() - start
+    if process.returncode:
+        raise SystemExit('import %s failed:\n%s' % (module, stderr))
+    return seconds, stderr
+
+
+def slowestImports(stderr, count):
+    """
+    :param stderr: (string) python -X importtime output
+    :param count: (integer) number of modules to return
+    :return:
+    [(cumulative microseconds, module name)] sorted slowest first.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = [f.strip() for f in line[len('import time:'):].split('|')]
+        if fields[1].isdigit():
+            imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def run(module, runs):
+    times = []
+    stderr = ''
+    for n in range(runs):
+        seconds, stderr = importOnce(module)
+        times.append(seconds)
+    times.sort()
+    return {'module': module, 'runs': runs,
+            'min_ms': times[0] * 1000,
+            'median_ms': times[len(times) // 2] * 1000,
+            'slowest': slowestImports(stderr, 15)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--module', default='api')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--baseline', help='fail on regressions against it')
+    parser.add_argument('--save-baseline', help='write this run to a file')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    result = run(args.module, args.runs)
+    print('import %s: min %.1f ms, median %.1f ms over %d runs' % (
+        result['module'], result['min_ms'], result['median_ms'],
+        result['runs']))
+    for microseconds, name in result['slowest']:
+        print('%10.1f ms  %s' % (microseconds / 1000.0, name))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        limit = baseline['median_ms'] * (1 + args.tolerance)
+        if result['median_ms'] > limit:
+            print('REGRESSION: median %.1f ms > %.1f ms' % (
+                result['median_ms'], baseline['median_ms']))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Per-call cost of resolving an item URL to its category and item,
+comparing the single baked joined lookup in queryhelpers with two
+rebuilt ORM Queries, each running bleach.clean on its URL segment.
+
+    python -m benchmarks.lookups [--items 100000] [--calls 5000]
+"""
+import argparse
+import random
+import timeit
+import bleach
+from setup import Category, Item
+from database import makeSessionFactory
+from queryhelpers import getCategoryItem
+from benchmarks.seed import createSeededDatabase
+
+
+def uncachedGetCategory(category_name, session):
+    return (session.query(Category)
+            .filter_by(name=bleach.clean(category_name))
+            .one())
+
+
+def uncachedGetItem(category_id, item_name, session):
+    return (session.query(Item)
+            .filter_by(category_id=category_id,
+                       name=bleach.clean(item_name.lower()))
+            .one())
+
+
+def uncachedGetCategoryItem(category_name, item_name, session):
+    category = uncachedGetCategory(category_name, session)
+    return category, uncachedGetItem(category.id, item_name, session)
+
+
+def run(items, calls, categories=100):
+    url, engine, names = createSeededDatabase(categories, items, users=10)
+    session = makeSessionFactory(engine)()
+    targets = [(names['categories'][n % categories], names['items'][n])
+               for n in random.sample(range(items), min(calls, items))]
+
+    def lookups(get_category_item):
+        for category_name, item_name in targets:
+            get_category_item(category_name, item_name, session)
+            # Keep the identity map from turning lookups into cache hits.
+            session.expunge_all()
+
+    results = {}
+    for label, get_category_item in (
+            ('rebuilt query', uncachedGetCategoryItem),
+            ('baked query', getCategoryItem)):
+        lookups(get_category_item)  # warm up
+        seconds = min(timeit.repeat(
+            lambda: lookups(get_category_item), number=1, repeat=3))
+        results[label] = seconds / len(targets) * 1e6
+        print "%-14s %8.1f us per item URL" % (label, results[label])
+    print "speedup        %8.2fx" % (results['rebuilt query'] /
+                                     results['baked query'])
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--calls', type=int, default=5000)
+    args = parser.parse_args()
+    run(args.items, args.calls)
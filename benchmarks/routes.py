@@ -0,0 +1,333 @@
+"""
+Load test for the Flask routes in api.py.
+Seeds a synthetic catalog, then requests every route through the Flask
+test client (one at a time, counting SQL queries) and through a local
+threaded WSGI server (at --concurrency). Reports p50/p99 latency,
+throughput, queries per request and peak RSS.
+
+    python -m benchmarks.routes --items 100000 --save-baseline base.json
+    python -m benchmarks.routes --items 100000 --baseline base.json
+
+With --baseline the run exits non-zero when a route got slower or
+issues more queries than recorded, or peak RSS grew, beyond --tolerance.
+The gconnect/gdisconnect OAuth routes call Google and are not driven.
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+from sqlalchemy import event
+from benchmarks.seed import createSeededDatabase
+
+# A fake, logged-in administrator who owns item 0 (see seedCatalog).
+LOGIN = {'user_id': 1, 'username': 'User 0', 'email': 'user0@example.com',
+         'is_admin': True}
+
+
+class Route(object):
+    """
+    One benchmarked request. path and data may use {n}, replaced by a
+    per-route counter, so that writes never collide.
+    """
+    def __init__(self, name, path, method='GET', login=False, data=None):
+        self.name = name
+        self.path = path
+        self.method = method
+        self.login = login
+        self.data = data
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            n = next(self.counter)
+        data = None
+        if self.data:
+            data = dict((key, value.format(n=n))
+                        for key, value in self.data.items())
+        return self.path.format(n=n), data
+
+    def reset(self):
+        self.counter = itertools.count()
+
+
+def buildRoutes(names):
+    """
+    :param names: (dictionary) seeded names from createSeededDatabase
+    :return:
+    List of Route objects covering api.py.
+    """
+    category = names['categories'][0]
+    item = names['items'][0]
+    item_path = '/catalog/%s/item/%s' % (category, item)
+    return [
+        Route('home', '/'),
+        Route('catalog', '/catalog'),
+        Route('catalog page 2',
+              '/catalog?after=%d' % (len(names['items']) / 2)),
+        Route('catalog json', '/catalog/JSON'),
+        Route('items json', '/catalog/items/JSON'),
+        Route('category items', '/catalog/%s/items' % category),
+        Route('category items json', '/catalog/%s/items/JSON' % category),
+        Route('search', '/catalog/search?q=item+1'),
+        Route('search json', '/catalog/search/JSON?q=synthetic'),
+        Route('categories', '/categories'),
+        Route('categories json', '/categories/JSON'),
+        Route('view item', item_path),
+        Route('view item json', item_path + '/JSON'),
+        Route('login', '/login'),
+        Route('disconnect', '/disconnect'),
+        Route('new item form', '/catalog/items/new', login=True),
+        Route('new item', '/catalog/%s/items/new' % category, 'POST', True,
+              {'name': 'Bench Item {n}', 'description': 'Benchmark.',
+               'category': '1'}),
+        Route('delete item form',
+              '/catalog/%s/item/bench item {n}/delete' % category,
+              login=True),
+        Route('delete item',
+              '/catalog/%s/item/bench item {n}/delete' % category,
+              'POST', True),
+        Route('edit item form', item_path + '/edit', login=True),
+        Route('edit item', item_path + '/edit', 'POST', True,
+              {'name': item.title(), 'description': 'Edited.',
+               'category': '1'}),
+        Route('new category form', '/categories/new', login=True),
+        Route('new category', '/categories/new', 'POST', True,
+              {'name': 'Bench Category {n}'}),
+        Route('edit category form', '/categories/bench category {n}/edit',
+              login=True),
+        Route('delete category', '/categories/bench category {n}/delete',
+              'POST', True),
+        Route('bulk export', '/catalog/items/bulk?format=ndjson', login=True),
+    ]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def summarize(latencies, seconds):
+    """
+    :param latencies: (list) request durations in seconds
+    :param seconds: (float) wall time taken by all of the requests
+    :return:
+    Dictionary of p50/p99 in milliseconds and requests per second.
+    """
+    return {'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'rps': len(latencies) / seconds}
+
+
+def runClient(app, engine, routes, requests):
+    """
+    Request every route sequentially through the Flask test client.
+    :return:
+    Dictionary of route name -> summary with the maximum query count.
+    """
+    queries = []
+    event.listen(engine, 'before_cursor_execute',
+                 lambda *args: queries.append(1))
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session.update(LOGIN)
+    results = {}
+    for route in routes:
+        route.reset()
+        latencies = []
+        counts = []
+        started = time.time()
+        for n in range(requests):
+            path, data = route.next()
+            del queries[:]
+            start = time.time()
+            response = client.open(path, method=route.method, data=data)
+            response.get_data()
+            latencies.append(time.time() - start)
+            counts.append(len(queries))
+            if response.status_code >= 500:
+                raise RuntimeError('%s returned %d' % (path,
+                                                       response.status_code))
+        results[route.name] = summarize(latencies, time.time() - started)
+        results[route.name]['queries'] = max(counts)
+    return results
+
+
+def sessionCookie(app):
+    """
+    :return:
+    Cookie header value carrying the LOGIN session.
+    """
+    sessions = app.session_interface
+    sid = sessions.newId()
+    sessions.backend.set(sessions.key(sid), dict(LOGIN), sessions.ttl)
+    return '%s=%s' % (app.session_cookie_name, sid)
+
+
+def runServer(app, routes, requests, concurrency):
+    """
+    Request every route through a local threaded WSGI server, with
+    concurrency clients at a time.
+    :return:
+    Dictionary of route name -> summary.
+    """
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_port
+    cookie = sessionCookie(app)
+    results = {}
+    try:
+        for route in routes:
+            route.reset()
+            latencies = []
+            errors = []
+            remaining = itertools.count()
+
+            def worker():
+                while next(remaining) < requests:
+                    path, data = route.next()
+                    headers = {'Cookie': cookie} if route.login else {}
+                    body = None
+                    if data:
+                        body = '&'.join('%s=%s' % pair
+                                        for pair in data.items())
+                        headers['Content-Type'] = ('application/'
+                                                   'x-www-form-urlencoded')
+                    start = time.time()
+                    connection = httplib.HTTPConnection('127.0.0.1', port)
+                    connection.request(route.method, path.replace(' ', '%20'),
+                                       body, headers)
+                    response = connection.getresponse()
+                    response.read()
+                    connection.close()
+                    latencies.append(time.time() - start)
+                    if response.status >= 500:
+                        errors.append('%s returned %d' % (path,
+                                                          response.status))
+            started = time.time()
+            workers = [threading.Thread(target=worker)
+                       for n in range(concurrency)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            if errors:
+                raise RuntimeError(errors[0])
+            results[route.name] = summarize(latencies, time.time() - started)
+    finally:
+        server.shutdown()
+    return results
+
+
+def peakRSS():
+    """
+    :return:
+    Peak resident set size of this process in KiB.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KiB.
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+def regressions(result, baseline, tolerance):
+    """
+    :param result: (dictionary) this run
+    :param baseline: (dictionary) a saved run
+    :param tolerance: (float) allowed relative slowdown, e.g. 0.25
+    :return:
+    List of messages, empty when nothing regressed.
+    """
+    messages = []
+    for mode in ('client', 'server'):
+        for name, old in baseline[mode].items():
+            new = result[mode].get(name)
+            if new is None:
+                continue
+            for key in ('p50_ms', 'p99_ms'):
+                if new[key] > old[key] * (1 + tolerance):
+                    messages.append('%s %s %s: %.1f > %.1f' % (
+                        mode, name, key, new[key], old[key]))
+            if new['rps'] < old['rps'] * (1 - tolerance):
+                messages.append('%s %s rps: %.1f < %.1f' % (
+                    mode, name, new['rps'], old['rps']))
+            if new.get('queries', 0) > old.get('queries', 0):
+                messages.append('%s %s queries: %d > %d' % (
+                    mode, name, new['queries'], old['queries']))
+    if result['peak_rss_kb'] > baseline['peak_rss_kb'] * (1 + tolerance):
+        messages.append('peak RSS: %d KiB > %d KiB' % (
+            result['peak_rss_kb'], baseline['peak_rss_kb']))
+    return messages
+
+
+def report(result):
+    print "%-22s %10s %10s %10s %8s | %10s %10s %10s" % (
+        'route', 'p50 ms', 'p99 ms', 'req/s', 'queries',
+        'srv p50', 'srv p99', 'srv req/s')
+    for name in sorted(result['client']):
+        client = result['client'][name]
+        server = result['server'].get(name, {})
+        print "%-22s %10.2f %10.2f %10.1f %8d | %10.2f %10.2f %10.1f" % (
+            name, client['p50_ms'], client['p99_ms'], client['rps'],
+            client['queries'], server.get('p50_ms', 0),
+            server.get('p99_ms', 0), server.get('rps', 0))
+    print "peak RSS: %d KiB" % result['peak_rss_kb']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=50,
+                        help='requests per route and mode')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--baseline', help='fail on regressions against it')
+    parser.add_argument('--save-baseline', help='write this run to a file')
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    args = parser.parse_args()
+
+    url, engine, names = createSeededDatabase(args.categories, args.items,
+                                              args.users)
+    # api builds its engine on import, from the environment.
+    os.environ['CATALOG_DATABASE_URL'] = url
+    import api
+    api.configureApp()
+    routes = buildRoutes(names)
+    result = {
+        'config': vars(args),
+        'client': runClient(api.app, api.engine, routes, args.requests),
+        'server': runServer(api.app, routes, args.requests,
+                            args.concurrency),
+        'peak_rss_kb': peakRSS(),
+    }
+    report(result)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            messages = regressions(result, json.load(f), args.tolerance)
+        for message in messages:
+            print "REGRESSION %s" % message
+        if messages:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Synthetic catalogs for the benchmarks.
+"""
+import os
+import tempfile
+from setup import Base, User, Category
+from database import createEngine, makeSessionFactory
+from bulk import importItems
+
+
+def seedCatalog(session, categories=10, items=1000, users=10):
+    """
+    Fill an empty database with users, categories and items in bulk.
+    Items are spread round-robin over categories and users.
+    :param session: (DBSession) SQLAlchemy session
+    :param categories: (integer) number of categories
+    :param items: (integer) total number of items
+    :param users: (integer) number of users
+    :return:
+    Dictionary with the seeded category and item names.
+    """
+    session.execute(User.__table__.insert(),
+                    [{'email': 'user%d@example.com' % n,
+                      'username': 'User %d' % n}
+                     for n in range(users)])
+    session.add_all([Category(name='Category %d' % n)
+                     for n in range(categories)])
+    session.commit()
+    user_ids = [row[0] for row in session.query(User.id)]
+
+    def rows():
+        for n in range(items):
+            yield n + 1, {'category': 'category %d' % (n % categories),
+                          'label': 'Item %d' % n,
+                          'description': 'Synthetic item number %d.' % n}
+    for user_id in user_ids:
+        # importItems assigns one owner, so split the rows between users.
+        owned = (row for row in rows()
+                 if (row[0] - 1) % len(user_ids) == user_ids.index(user_id))
+        importItems(owned, session, user_id, batch_size=5000)
+    return {'categories': ['category %d' % n for n in range(categories)],
+            'items': ['item %d' % n for n in range(items)]}
+
+
+def createSeededDatabase(categories=10, items=1000, users=10, path=None):
+    """
+    Create and seed a SQLite database file.
+    :param path: (string) database file, a temporary file when None
+    :return:
+    (url, engine, seeded names) tuple.
+    """
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix='.db', prefix='catalog-bench-')
+        os.close(handle)
+        os.remove(path)
+    url = 'sqlite:///%s' % path
+    engine = createEngine(url)
+    Base.metadata.create_all(engine)
+    session = makeSessionFactory(engine)()
+    names = seedCatalog(session, categories, items, users)
+    session.close()
+    return url, engine, names
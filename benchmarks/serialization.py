@@ -0,0 +1,134 @@
+"""
+Cost of encoding and sending the item listing as JSON.
+Encodes every item of a seeded catalog the way jsonify did (pretty
+printed under the debug server, compact otherwise) and the way
+jsonresponse does, then pages through /catalog/items/JSON with and
+without compression.
+
+    python -m benchmarks.serialization [--items 100000]
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+import timeit
+from benchmarks.seed import createSeededDatabase
+
+
+def encoders(jsonresponse):
+    """
+    :param jsonresponse: the jsonresponse module
+    :return:
+    List of (label, function) pairs encoding a dictionary to JSON.
+    """
+    results = [
+        ('jsonify, debug', lambda obj: json.dumps(
+            obj, indent=2, separators=(', ', ': '), sort_keys=True)),
+        ('jsonify', lambda obj: json.dumps(
+            obj, separators=(',', ':'), sort_keys=True)),
+        ('dumps, stdlib', lambda obj: json.dumps(
+            obj, sort_keys=True, separators=(',', ':')).encode('utf-8')),
+    ]
+    if jsonresponse.orjson is not None:
+        orjson = jsonresponse.orjson
+        results.append(('dumps, orjson', lambda obj: orjson.dumps(
+            obj, option=orjson.OPT_SORT_KEYS)))
+    return results
+
+
+def runEncoding(jsonresponse, items):
+    """
+    Time encoding every item in one document, and compare sizes.
+    :param jsonresponse: the jsonresponse module
+    :param items: (list) serialized items
+    """
+    document = {'items': items, 'next_after': None}
+    print "%-16s %10s %12s %12s %12s" % ('encoder', 'ms', 'bytes',
+                                        'gzip bytes', 'br bytes')
+    for label, encode in encoders(jsonresponse):
+        seconds = min(timeit.repeat(lambda: encode(document),
+                                    number=1, repeat=3))
+        data = encode(document)
+        brotli = (len(jsonresponse.compress(data, 'br'))
+                  if jsonresponse.brotli is not None else 0)
+        print "%-16s %10.1f %12d %12d %12d" % (
+            label, seconds * 1000, len(data),
+            len(jsonresponse.compress(data, 'gzip')), brotli)
+
+
+def decodeBody(jsonresponse, response):
+    """
+    :return:
+    JSON document of a possibly compressed response.
+    """
+    data = response.data
+    encoding = response.headers.get('Content-Encoding')
+    if encoding == 'gzip':
+        data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+    elif encoding == 'br':
+        data = jsonresponse.brotli.decompress(data)
+    return json.loads(data)
+
+
+def runRoute(app, jsonresponse, limit):
+    """
+    Page through /catalog/items/JSON with each Accept-Encoding,
+    counting the bytes sent.
+    :param app: (Flask) application
+    :param jsonresponse: the jsonresponse module
+    :param limit: (integer) items per page
+    """
+    client = app.test_client()
+    print "%-16s %10s %12s %8s" % ('accept-encoding', 'ms', 'bytes', 'pages')
+    for encoding in ('identity', 'gzip', 'br'):
+        if encoding == 'br' and jsonresponse.brotli is None:
+            continue
+        pages = 0
+        size = 0
+        after = None
+        start = timeit.default_timer()
+        while pages == 0 or after:
+            url = '/catalog/items/JSON?limit=%d' % limit
+            if after:
+                url += '&after=%d' % after
+            response = client.get(url, headers={'Accept-Encoding': encoding})
+            size += len(response.data)
+            pages += 1
+            after = decodeBody(jsonresponse, response)['next_after']
+        print "%-16s %10.1f %12d %8d" % (
+            encoding, (timeit.default_timer() - start) * 1000, size, pages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--categories', type=int, default=100)
+    parser.add_argument('--limit', type=int, default=500,
+                        help='items per page of the route')
+    args = parser.parse_args()
+
+    url, engine, names = createSeededDatabase(args.categories, args.items,
+                                              users=10)
+    # api builds its engine on import, from the environment.
+    os.environ['CATALOG_DATABASE_URL'] = url
+    import api
+    import jsonresponse
+    session = api.DBSession()
+    items = []
+    after = None
+    while True:
+        page = api.getItems(session, after, args.limit)
+        items.extend(item.serialize for item in page)
+        after = api.nextCursor(page, args.limit)
+        if after is None:
+            break
+    session.close()
+    print "%d items, encoder %s" % (len(items), jsonresponse.ENCODER)
+    runEncoding(jsonresponse, items)
+    print
+    runRoute(api.app, jsonresponse, args.limit)
+
+
+if __name__ == '__main__':
+    main()
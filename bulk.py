@@ -0,0 +1,262 @@
+"""
+Bulk item import and export in CSV or NDJSON.
+Rows are read and written as streams. Imports resolve category names
+once, then insert batch_size rows per transaction with one Core
+executemany each. Rows that violate a constraint are reported and
+skipped without aborting the rest of their batch.
+
+Usage:
+    python bulk.py import items.csv --user-id 1
+    python bulk.py export --format ndjson > items.ndjson
+"""
+import csv
+import json
+from sqlalchemy import select, text
+from sqlalchemy.exc import IntegrityError
+from setup import Category, Item
+from queryhelpers import clean, invalidateCategoryItems, adjustItemCount
+
+FORMATS = ('csv', 'ndjson')
+FIELDS = ('category', 'label', 'description')
+# Stay below SQLITE_MAX_VARIABLE_NUMBER on older SQLite builds.
+MAX_PARAMETERS = 500
+
+
+def decode(value):
+    """
+    :param value: (string) text or utf-8 encoded bytes
+    :return:
+    unicode text
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def readRows(lines, fmt):
+    """
+    Parse item rows from an iterable of lines.
+    :param lines: iterable of CSV lines with a header row, or NDJSON lines
+    :param fmt: (string) 'csv' or 'ndjson'
+    :return:
+    Generator of (line number, dictionary) pairs.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, dict((decode(key), decode(value))
+                                        for key, value in row.items())
+        return
+    for line_num, line in enumerate(lines, 1):
+        line = decode(line).strip()
+        if line:
+            try:
+                yield line_num, json.loads(line)
+            except ValueError:
+                yield line_num, None
+
+
+def validateRow(row, category_ids, user_id):
+    """
+    Build the item values for a row, cleaned the same way as addItem.
+    :param row: (dictionary) parsed row
+    :param category_ids: (dictionary) Category.name -> Category.id
+    :param user_id: (integer) owner of the imported items
+    :return:
+    (values, error) tuple; exactly one of them is None.
+    """
+    if not isinstance(row, dict):
+        return None, 'Malformed row.'
+    for field in ('label', 'name', 'category', 'description'):
+        value = row.get(field)
+        if value is not None and not isinstance(value, basestring):
+            return None, '"%s" must be text.' % field
+    label = clean(row.get('label') or row.get('name') or '')
+    if len(label) < 1:
+        return None, 'Name cannot be empty.'
+    category = clean(row.get('category') or '').lower()
+    if category not in category_ids:
+        return None, 'Unknown category "%s".' % category
+    return {'name': label.lower(),
+            'label': label,
+            'description': clean(row.get('description') or ''),
+            'category_id': category_ids[category],
+            'user_id': user_id}, None
+
+
+def insertBatch(batch, session):
+    """
+    Insert one batch in its own transaction.
+    :param batch: (list) (line number, values) pairs
+    :param session: (DBSession) SQLAlchemy session
+    :return:
+    (number inserted, list of errors) tuple.
+    """
+    errors = []
+    # Reject duplicates up front so that executemany normally succeeds.
+    # Looking names up per category lets unique_index_1 serve the query.
+    names = {}
+    for line_num, values in batch:
+        names.setdefault(values['category_id'], set()).add(values['name'])
+    existing = set()
+    for category_id, category_names in names.items():
+        category_names = list(category_names)
+        for start in range(0, len(category_names), MAX_PARAMETERS):
+            existing.update((category_id, name) for name, in session.execute(
+                select([Item.name])
+                .where(Item.category_id == category_id)
+                .where(Item.name.in_(
+                    category_names[start:start + MAX_PARAMETERS]))))
+    accepted = []
+    for line_num, values in batch:
+        key = (values['category_id'], values['name'])
+        if key in existing:
+            errors.append({'line': line_num,
+                           'error': 'Duplicate item name in category '
+                                    '(unique_index_1).'})
+            continue
+        existing.add(key)
+        accepted.append((line_num, values))
+    if not accepted:
+        return 0, errors
+    try:
+        insertRows([values for line_num, values in accepted], session)
+        session.commit()
+        return len(accepted), errors
+    except IntegrityError:
+        # A concurrent writer got there first; retry row by row.
+        session.rollback()
+    inserted = 0
+    for line_num, values in accepted:
+        try:
+            insertRows([values], session)
+            session.commit()
+            inserted += 1
+        except IntegrityError as e:
+            session.rollback()
+            errors.append({'line': line_num, 'error': str(e.orig)})
+    return inserted, errors
+
+
+def insertRows(rows, session):
+    """
+    Insert rows with a single executemany, add them to the search index
+    and to their categories' item counts.
+    :param rows: (list) dictionaries of item values
+    :param session: (DBSession) SQLAlchemy session
+    """
+    last_id = session.execute(select([Item.id])
+                              .order_by(Item.id.desc())
+                              .limit(1)).scalar() or 0
+    session.execute(Item.__table__.insert(), rows)
+    counts = {}
+    for values in rows:
+        counts[values['category_id']] = counts.get(values['category_id'],
+                                                   0) + 1
+    for category_id, count in counts.items():
+        adjustItemCount(category_id, count, session)
+    if session.get_bind().dialect.name == 'sqlite':
+        session.execute(text('INSERT INTO item_search '
+                             '(rowid, label, description) '
+                             'SELECT id, label, description FROM item '
+                             'WHERE id > :last_id'), {'last_id': last_id})
+
+
+def importItems(rows, session, user_id, batch_size=1000):
+    """
+    Insert parsed rows as items owned by user_id.
+    :param rows: iterable of (line number, dictionary) pairs from readRows
+    :param session: (DBSession) SQLAlchemy session
+    :param user_id: (integer) owner of the imported items
+    :param batch_size: (integer) number of rows per transaction
+    :return:
+    Dictionary with the number of inserted items and per-row errors.
+    """
+    category_ids = dict(session.query(Category.name, Category.id))
+    inserted = 0
+    errors = []
+    touched = set()
+    batch = []
+    for line_num, row in rows:
+        values, error = validateRow(row, category_ids, user_id)
+        if error:
+            errors.append({'line': line_num, 'error': error})
+            continue
+        batch.append((line_num, values))
+        if len(batch) >= batch_size:
+            count, batch_errors = insertBatch(batch, session)
+            inserted += count
+            errors.extend(batch_errors)
+            touched.update(values['category_id'] for n, values in batch)
+            batch = []
+    if batch:
+        count, batch_errors = insertBatch(batch, session)
+        inserted += count
+        errors.extend(batch_errors)
+        touched.update(values['category_id'] for n, values in batch)
+    for category_id in touched:
+        invalidateCategoryItems(category_id)
+    errors.sort(key=lambda error: error['line'])
+    return {'inserted': inserted, 'errors': errors}
+
+
+def exportItems(session, fmt, batch_size=1000):
+    """
+    Stream every item in the format importItems reads.
+    :param session: (DBSession) SQLAlchemy session
+    :param fmt: (string) 'csv' or 'ndjson'
+    :param batch_size: (integer) number of rows fetched per round trip
+    :return:
+    Generator of utf-8 encoded lines.
+    """
+    rows = (session.query(Category.name, Item.label, Item.description)
+            .join(Item, Item.category_id == Category.id)
+            .order_by(Item.id)
+            .yield_per(batch_size))
+    if fmt == 'csv':
+        yield ','.join(FIELDS) + '\r\n'
+        for row in rows:
+            yield ','.join(csvField(value) for value in row) + '\r\n'
+        return
+    for row in rows:
+        yield json.dumps(dict(zip(FIELDS, row))) + '\n'
+
+
+def csvField(value):
+    """
+    :param value: (string) field value
+    :return:
+    utf-8 encoded CSV field, quoted when needed.
+    """
+    value = (value or u'').encode('utf-8')
+    if any(c in value for c in ',"\r\n'):
+        return '"%s"' % value.replace('"', '""')
+    return value
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description='Bulk item import/export.')
+    parser.add_argument('command', choices=('import', 'export'))
+    parser.add_argument('path', nargs='?', help='file to import')
+    parser.add_argument('--format', choices=FORMATS,
+                        help='defaults to the file extension, or ndjson')
+    parser.add_argument('--user-id', type=int, default=1,
+                        help='owner of imported items')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    from database import createEngine, makeSessionFactory
+    session = makeSessionFactory(createEngine())()
+    if args.command == 'export':
+        for line in exportItems(session, args.format or 'ndjson'):
+            sys.stdout.write(line)
+    else:
+        fmt = args.format or ('csv' if args.path.endswith('.csv')
+                              else 'ndjson')
+        with open(args.path, 'rb') as lines:
+            result = importItems(readRows(lines, fmt), session,
+                                 args.user_id, args.batch_size)
+        for error in result['errors']:
+            sys.stderr.write('line %(line)d: %(error)s\n' % error)
+        print "Imported %d items." % result['inserted']
@@ -0,0 +1,313 @@
+"""
+Read-through cache used by queryhelpers.
+Values expire after a TTL and the least recently used entries are
+evicted first. Invalidation works through generation counters: every
+cache key embeds the generation of its namespace, so bumping the counter
+orphans all of the namespace's entries at once.
+"""
+from collections import OrderedDict
+import os
+import pickle
+import random
+import sqlite3
+import threading
+import time
+
+
+def sizeOf(value):
+    """
+    :param value: cached value
+    :return:
+    approximate size of value in bytes.
+    """
+    if isinstance(value, bytes):
+        return len(value)
+    return len(pickle.dumps(value, 2))
+
+
+class MemoryCacheBackend(object):
+    """
+    In-process LRU cache. Only coherent within a single worker process.
+    It holds at most max_entries values, and when max_bytes is set, at
+    most that many bytes of them, as measured by sizeOf.
+    """
+    def __init__(self, max_entries=1024, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._epoch = None
+        self._pid = None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires, size = entry
+            if expires is not None and expires < time.time():
+                self._bytes -= size
+                return None
+            # Re-insert to mark the entry as most recently used.
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        size = sizeOf(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, expires, size)
+            self._bytes += size
+            while ((self.max_entries and
+                    len(self._entries) > self.max_entries) or
+                   (self.max_bytes and self._bytes > self.max_bytes)):
+                self._bytes -= self._entries.popitem(last=False)[1][2]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def incr(self, key):
+        # Counters live outside the LRU so they are never evicted.
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def epoch(self):
+        # Counters restart from zero with the process, so versions built
+        # from them are only comparable within one epoch. A forked worker
+        # draws its own, since its counters no longer follow the master's.
+        if self._pid != os.getpid():
+            self._epoch = '%08x' % random.getrandbits(32)
+            self._pid = os.getpid()
+        return self._epoch
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+class SqliteCacheBackend(object):
+    """
+    Cache stored in a local SQLite file that every worker process opens.
+    Stands in for a shared store such as memcached or redis, so that an
+    invalidation in one worker is seen by all the others.
+    Eviction is approximately least recently used: a hit only records
+    its access time when the last one is over touch_interval seconds
+    old, so that most reads do not take the file's write lock, and
+    expired and excess entries are deleted once every evict_every sets
+    of a connection, so the table may briefly exceed max_entries.
+    """
+    def __init__(self, path, max_entries=10000, touch_interval=60,
+                 evict_every=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.evict_every = evict_every
+        self._local = threading.local()
+
+    def _connection(self):
+        # One connection per thread and per process, since neither
+        # sqlite3 connections nor their locks survive a fork.
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                               'key TEXT PRIMARY KEY, value BLOB, '
+                               'expires REAL, accessed REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_expires '
+                               'ON cache (expires)')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed '
+                               'ON cache (accessed)')
+            connection.execute('CREATE TABLE IF NOT EXISTS counters ('
+                               'key TEXT PRIMARY KEY, value INTEGER)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+            self._local.epoch = None
+            self._local.sets = 0
+        return self._local.connection
+
+    def get(self, key):
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute(
+            'SELECT value, accessed FROM cache WHERE key = ? '
+            'AND (expires IS NULL OR expires >= ?)', (key, now)).fetchone()
+        if row is None:
+            return None
+        if row[1] < now - self.touch_interval:
+            connection.execute('UPDATE cache SET accessed = ? WHERE key = ?',
+                               (now, key))
+        return pickle.loads(bytes(row[0]))
+
+    def set(self, key, value, ttl=None):
+        connection = self._connection()
+        now = time.time()
+        connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires, accessed) '
+            'VALUES (?, ?, ?, ?)',
+            (key, sqlite3.Binary(pickle.dumps(value, 2)),
+             now + ttl if ttl else None, now))
+        self._local.sets += 1
+        if self._local.sets % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete expired entries, then the least recently used ones over
+        max_entries. Both are found through an index.
+        """
+        connection = self._connection()
+        connection.execute('DELETE FROM cache WHERE expires < ?',
+                           (time.time(),))
+        connection.execute(
+            'DELETE FROM cache WHERE accessed < ('
+            'SELECT accessed FROM cache ORDER BY accessed DESC '
+            'LIMIT 1 OFFSET ?)', (self.max_entries - 1,))
+
+    def delete(self, key):
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def counter(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM counters WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def incr(self, key):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'INSERT OR IGNORE INTO counters (key, value) VALUES (?, 0)',
+                (key,))
+            connection.execute(
+                'UPDATE counters SET value = value + 1 WHERE key = ?', (key,))
+            value = connection.execute(
+                'SELECT value FROM counters WHERE key = ?',
+                (key,)).fetchone()[0]
+        except sqlite3.Error:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return value
+
+    def epoch(self):
+        # Drawn once per file, so it is read once per connection.
+        connection = self._connection()
+        if self._local.epoch is None:
+            connection.execute(
+                'INSERT OR IGNORE INTO counters (key, value) VALUES (?, ?)',
+                ('epoch', random.getrandbits(31)))
+            self._local.epoch = '%08x' % self.counter('epoch')
+        return self._local.epoch
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+
+
+class Cache(object):
+    """
+    Read-through cache with namespace invalidation and hit/miss counters.
+    """
+    def __init__(self, backend=None, ttl=300):
+        self.backend = backend or MemoryCacheBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, namespace):
+        """
+        :param namespace: (string) e.g. 'categories' or 'items:3'
+        :return:
+        number of times namespace has been invalidated.
+        """
+        return self.backend.counter(namespace)
+
+    def version(self, namespace):
+        """
+        :param namespace: (string)
+        :return:
+        string that changes whenever namespace is invalidated,
+        unique across backend restarts.
+        """
+        return '%s-%d' % (self.backend.epoch(), self.generation(namespace))
+
+    def key(self, namespace, *parts):
+        """
+        Build a key for namespace that changes whenever it is invalidated.
+        :param namespace: (string) e.g. 'categories' or 'items:3'
+        :param parts: values identifying the entry inside the namespace
+        :return:
+        string cache key
+        """
+        return ':'.join([namespace, str(self.generation(namespace))] +
+                        [str(part) for part in parts])
+
+    def fetch(self, key, load, ttl=None):
+        """
+        Return the cached value for key, calling load() on a miss.
+        Falsy results other than empty lists are not cached, because the
+        query helpers return False on database errors.
+        :param key: (string) key built with Cache.key
+        :param load: (function) computes the value on a miss
+        :param ttl: (integer) seconds to keep the value, defaults to self.ttl
+        :return:
+        cached or freshly loaded value
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = load()
+        if value or value == []:
+            self.set(key, value, ttl)
+        return value
+
+    def get(self, key):
+        """
+        :param key: (string) key built with Cache.key
+        :return:
+        cached value, or None on a miss.
+        """
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        :param key: (string) key built with Cache.key
+        :param value: value to store
+        :param ttl: (integer) seconds to keep the value, defaults to self.ttl
+        """
+        self.backend.set(key, value, ttl or self.ttl)
+
+    def invalidate(self, namespace):
+        """
+        Orphan every entry stored under namespace.
+        :param namespace: (string)
+        """
+        self.backend.incr(namespace)
+
+    def stats(self):
+        """
+        :return:
+        dictionary of hit and miss counts for this process.
+        """
+        return {'hits': self.hits, 'misses': self.misses}
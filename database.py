@@ -0,0 +1,170 @@
+"""
+Database engine and session configuration.
+Every entry point gets its engine from createEngine so the connection
+settings live in one place. They are read from the environment:
+
+CATALOG_DATABASE_URL        SQLAlchemy URL, default sqlite:///catalog.db
+CATALOG_REPLICA_URL         optional read replica used for GET requests
+CATALOG_POOL_SIZE           connections kept open in the pool (5)
+CATALOG_MAX_OVERFLOW        extra connections allowed under load (10)
+CATALOG_POOL_RECYCLE        seconds before a connection is replaced (3600)
+CATALOG_STATEMENT_TIMEOUT   milliseconds a statement may run, 0 for none
+CATALOG_SQLITE_CACHE_SIZE   SQLite page cache per connection in KiB (65536)
+CATALOG_SQLITE_MMAP_SIZE    bytes of the SQLite file to mmap (268435456)
+"""
+import os
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_URL = 'sqlite:///catalog.db'
+
+
+def setting(name, default):
+    """
+    Read a setting from the environment, converted to default's type.
+    :param name: (string) environment variable name
+    :param default: value used when the variable is not set
+    :return:
+    setting value
+    """
+    value = os.environ.get(name)
+    if value is None or default is None:
+        return value if value is not None else default
+    return type(default)(value)
+
+
+def createEngine(url=None):
+    """
+    Create an engine for url with the configured pool and timeouts.
+    SQLite files are opened in WAL mode so that readers are not
+    serialized behind writers.
+    :param url: (string) SQLAlchemy URL, defaults to CATALOG_DATABASE_URL
+    :return:
+    Engine
+    """
+    url = make_url(url or setting('CATALOG_DATABASE_URL', DEFAULT_URL))
+    timeout = setting('CATALOG_STATEMENT_TIMEOUT', 0)
+    options = {
+        'pool_pre_ping': True,
+        'pool_size': setting('CATALOG_POOL_SIZE', 5),
+        'max_overflow': setting('CATALOG_MAX_OVERFLOW', 10),
+        'pool_recycle': setting('CATALOG_POOL_RECYCLE', 3600),
+    }
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            # In-memory databases live and die with their only connection.
+            return create_engine(url)
+        # Pool file connections, as for other databases, so that the
+        # pragmas and page cache below survive between checkouts.
+        options['poolclass'] = QueuePool
+        options['connect_args'] = {'check_same_thread': False}
+        engine = create_engine(url, **options)
+        event.listen(engine, 'connect', sqlitePragmas)
+        if timeout:
+            sqliteStatementTimeout(engine, timeout)
+        return engine
+    if timeout and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {
+            'options': '-c statement_timeout=%d' % timeout}
+    elif timeout and url.get_backend_name() == 'mysql':
+        options['connect_args'] = {'init_command':
+                                   'SET SESSION max_execution_time=%d'
+                                   % timeout}
+    return create_engine(url, **options)
+
+
+def createReplicaEngine():
+    """
+    :return:
+    Engine for CATALOG_REPLICA_URL, or None when no replica is configured.
+    """
+    url = setting('CATALOG_REPLICA_URL', None)
+    return createEngine(url) if url else None
+
+
+def sqlitePragmaStatements():
+    """
+    :return:
+    PRAGMA statements that tune an SQLite connection for concurrent
+    reads, also run by the async connections in asgi.py.
+    """
+    return ['PRAGMA journal_mode=WAL',
+            'PRAGMA synchronous=NORMAL',
+            'PRAGMA cache_size=-%d' % setting('CATALOG_SQLITE_CACHE_SIZE',
+                                              65536),
+            'PRAGMA mmap_size=%d' % setting('CATALOG_SQLITE_MMAP_SIZE',
+                                            268435456)]
+
+
+def sqlitePragmas(dbapi_connection, connection_record):
+    """
+    Tune every new SQLite connection for concurrent reads.
+    """
+    cursor = dbapi_connection.cursor()
+    for statement in sqlitePragmaStatements():
+        cursor.execute(statement)
+    cursor.close()
+
+
+def sqliteStatementTimeout(engine, timeout):
+    """
+    Interrupt SQLite statements that run longer than timeout.
+    SQLite has no statement timeout, so a progress handler checks a
+    deadline set before each statement and cleared once it returns.
+    :param engine: (Engine) SQLite engine
+    :param timeout: (integer) milliseconds
+    """
+    @event.listens_for(engine, 'connect')
+    def installHandler(dbapi_connection, connection_record):
+        connection_record.info['deadline'] = None
+
+        def checkDeadline():
+            deadline = connection_record.info['deadline']
+            # A non-zero return value aborts the statement.
+            return deadline is not None and time.time() > deadline
+        dbapi_connection.set_progress_handler(checkDeadline, 10000)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def setDeadline(conn, cursor, statement, parameters, context,
+                    executemany):
+        conn.connection._connection_record.info['deadline'] = (
+            time.time() + timeout / 1000.0)
+
+    # Rows fetched after execute returns, as when a result is streamed,
+    # run at the caller's pace, so they are not timed.
+    @event.listens_for(engine, 'after_cursor_execute')
+    def clearDeadline(conn, cursor, statement, parameters, context,
+                      executemany):
+        conn.connection._connection_record.info['deadline'] = None
+
+
+class RoutingSession(Session):
+    """
+    Session that reads from a replica while use_replica() is true.
+    Flushes, and every session without a replica, use the primary bind.
+    """
+    def __init__(self, replica=None, use_replica=None, **kwargs):
+        super(RoutingSession, self).__init__(**kwargs)
+        self.replica = replica
+        self.use_replica = use_replica
+
+    def get_bind(self, mapper=None, clause=None):
+        if (self.replica is not None and not self._flushing and
+                self.use_replica is not None and self.use_replica()):
+            return self.replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+def makeSessionFactory(engine, replica=None, use_replica=None):
+    """
+    :param engine: (Engine) primary database
+    :param replica: (Engine) optional read replica
+    :param use_replica: (function) returns True when reads may use replica
+    :return:
+    sessionmaker producing RoutingSession objects.
+    """
+    return sessionmaker(class_=RoutingSession, bind=engine,
+                        replica=replica, use_replica=use_replica)
@@ -0,0 +1,177 @@
+"""
+Google OAuth calls made by gconnect and gdisconnect.
+Every call goes through one pooled keep-alive HTTP session with a
+timeout, so a slow Google endpoint cannot hold a worker indefinitely.
+The token and profile lookups run concurrently, profiles are reused
+for a few minutes, and revocation runs in the background.
+
+CATALOG_OAUTH_TIMEOUT       seconds to wait for each call (5)
+CATALOG_OAUTH_POOL_SIZE     keep-alive connections and threads (10)
+CATALOG_PROFILE_CACHE_TTL   seconds a user's profile is reused by their
+                            next logins (300)
+CATALOG_GOOGLE_TOKEN_URL    code exchange, default token_uri from
+                            client_secrets.json
+CATALOG_GOOGLE_TOKENINFO_URL, CATALOG_GOOGLE_USERINFO_URL,
+CATALOG_GOOGLE_REVOKE_URL   override the Google endpoints, e.g. with
+                            a local stub server in tests
+"""
+import base64
+import json
+import logging
+import os
+from cache import Cache, MemoryCacheBackend
+from database import setting
+
+TIMEOUT = setting('CATALOG_OAUTH_TIMEOUT', 5.0)
+POOL_SIZE = setting('CATALOG_OAUTH_POOL_SIZE', 10)
+TOKEN_URL = setting('CATALOG_GOOGLE_TOKEN_URL', None)
+TOKENINFO_URL = setting('CATALOG_GOOGLE_TOKENINFO_URL',
+                        'https://www.googleapis.com/oauth2/v1/tokeninfo')
+USERINFO_URL = setting('CATALOG_GOOGLE_USERINFO_URL',
+                       'https://www.googleapis.com/oauth2/v1/userinfo')
+REVOKE_URL = setting('CATALOG_GOOGLE_REVOKE_URL',
+                     'https://accounts.google.com/o/oauth2/revoke')
+
+# Keyed by Google user id. Every login gets a new access token, which
+# is always verified, but the same user's profile rarely changes.
+profiles = Cache(MemoryCacheBackend(max_entries=10000),
+                 ttl=setting('CATALOG_PROFILE_CACHE_TTL', 300))
+
+log = logging.getLogger(__name__)
+_local = {'pid': None}
+
+
+class OAuthError(Exception):
+    """
+    A Google OAuth call failed, timed out or returned an error.
+    """
+
+
+def client():
+    """
+    :return:
+    (requests.Session, ThreadPool) shared by this process, created on
+    first use and again after a fork, since neither survives one.
+    """
+    if _local['pid'] != os.getpid():
+        # Imported here, on the first login, to keep worker start fast.
+        from multiprocessing.pool import ThreadPool
+        import requests
+        from requests.adapters import HTTPAdapter
+        http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                              pool_maxsize=POOL_SIZE)
+        http.mount('http://', adapter)
+        http.mount('https://', adapter)
+        _local['http'] = http
+        _local['pool'] = ThreadPool(POOL_SIZE)
+        _local['pid'] = os.getpid()
+    return _local['http'], _local['pool']
+
+
+def call(method, url, **kwargs):
+    """
+    Make one request through the pooled session.
+    :param method: (string) HTTP method
+    :param url: (string)
+    :return:
+    decoded JSON body, or {} when there is none.
+    """
+    import requests
+    http = client()[0]
+    try:
+        response = http.request(method, url, timeout=TIMEOUT, **kwargs)
+        response.raise_for_status()
+        return response.json() if response.content else {}
+    except (requests.RequestException, ValueError) as e:
+        raise OAuthError('%s %s failed: %s' % (method, url, e))
+
+
+def decodeIdToken(id_token):
+    """
+    Read the claims of an id_token received directly from Google's
+    token endpoint over TLS, so its signature need not be checked.
+    :param id_token: (string) JWT
+    :return:
+    dictionary of claims
+    """
+    try:
+        payload = id_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(str(payload)))
+    except (AttributeError, IndexError, TypeError, ValueError):
+        raise OAuthError('Malformed id_token.')
+
+
+def exchangeCode(code, secrets):
+    """
+    Upgrade a one-time authorization code into tokens.
+    :param code: (string) authorization code posted by the login page
+    :param secrets: (dictionary) 'web' section of client_secrets.json
+    :return:
+    (access token, Google user id) tuple.
+    """
+    tokens = call('POST', TOKEN_URL or secrets['token_uri'],
+                  data={'code': code,
+                        'client_id': secrets['client_id'],
+                        'client_secret': secrets['client_secret'],
+                        'redirect_uri': 'postmessage',
+                        'grant_type': 'authorization_code'})
+    if 'access_token' not in tokens or 'id_token' not in tokens:
+        raise OAuthError('No tokens in the exchange response.')
+    return tokens['access_token'], decodeIdToken(tokens['id_token'])['sub']
+
+
+def fetchTokenAndProfile(access_token, gplus_id):
+    """
+    Fetch the token info and the user's profile concurrently.
+    Profiles fetched in the last CATALOG_PROFILE_CACHE_TTL seconds are
+    answered from memory, so only the token is checked.
+    :param access_token: (string)
+    :param gplus_id: (string) Google user id the token was issued for
+    :return:
+    (tokeninfo dictionary, userinfo dictionary) tuple.
+    """
+    pool = client()[1]
+    tokeninfo = pool.apply_async(call, ('GET', TOKENINFO_URL),
+                                 {'params': {'access_token': access_token}})
+    key = profiles.key('profile', gplus_id)
+    userinfo = profiles.get(key)
+    if userinfo is None:
+        # Each call has its own timeout, so these waits are bounded.
+        userinfo = pool.apply_async(call, ('GET', USERINFO_URL),
+                                    {'params': {'access_token': access_token,
+                                                'alt': 'json'}}).get()
+        tokeninfo = tokeninfo.get()
+        # Only kept once the token is known to belong to gplus_id.
+        if (tokeninfo.get('error') is None and
+                tokeninfo.get('user_id') == gplus_id):
+            profiles.set(key, userinfo)
+        return tokeninfo, userinfo
+    return tokeninfo.get(), userinfo
+
+
+def revokeToken(access_token):
+    """
+    Revoke an access token in the background.
+    :param access_token: (string)
+    :return:
+    AsyncResult whose get() returns once Google has answered.
+    """
+    pool = client()[1]
+    return pool.apply_async(revokeQuietly, (access_token,))
+
+
+def revokeQuietly(access_token):
+    """
+    Revoke an access token, logging rather than raising failures.
+    :param access_token: (string)
+    :return:
+    True when Google revoked the token.
+    """
+    try:
+        call('GET', REVOKE_URL, params={'token': access_token})
+        return True
+    except OAuthError as e:
+        log.warning('Failed to revoke token: %s', e)
+        return False
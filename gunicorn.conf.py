@@ -0,0 +1,36 @@
+"""
+gunicorn settings for wsgi.py, read from the environment:
+
+CATALOG_BIND                address to listen on (0.0.0.0:8000)
+CATALOG_WORKERS             worker processes (2 per CPU core, plus one)
+CATALOG_THREADS             threads per worker (1)
+CATALOG_TIMEOUT             seconds before a silent worker is restarted (30)
+
+The app is loaded once in the master before it forks, so imports,
+mapper configuration and compiled templates are shared by the workers.
+With more than one worker, CATALOG_CACHE_PATH defaults to
+catalog-cache.db, so that every worker sees the others' invalidations
+and answers conditional GETs from the same catalog version, and
+CATALOG_SESSION_PATH to catalog-sessions.db, so that a session started
+in one worker is found by the others.
+"""
+import multiprocessing
+import os
+from database import setting
+
+bind = setting('CATALOG_BIND', '0.0.0.0:8000')
+workers = setting('CATALOG_WORKERS', multiprocessing.cpu_count() * 2 + 1)
+threads = setting('CATALOG_THREADS', 1)
+timeout = setting('CATALOG_TIMEOUT', 30)
+preload_app = True
+
+# Read when the app is preloaded, after this file.
+if workers > 1:
+    os.environ.setdefault('CATALOG_CACHE_PATH', 'catalog-cache.db')
+    os.environ.setdefault('CATALOG_SESSION_PATH', 'catalog-sessions.db')
+
+
+def post_fork(server, worker):
+    # The engines were created in the master, before the fork.
+    import api
+    api.afterFork()
@@ -0,0 +1,272 @@
+"""
+Opt-in per-request instrumentation, enabled with CATALOG_INSTRUMENT=1.
+For every request it records the wall time spent in SQL, template
+rendering and bleach, and each SQL statement with its duration and
+whether it came from a lazy load. Totals are served at /_metrics in
+the Prometheus text format.
+
+CATALOG_SLOW_REQUEST_MS     log requests slower than this (500)
+CATALOG_PROFILE_SAMPLE      fraction of requests run under cProfile (0);
+                            the profile is logged when they are slow
+"""
+import cProfile
+import pstats
+import random
+import sys
+import threading
+import time
+from flask import g, has_request_context, request, Response
+from jinja2 import Template
+from sqlalchemy import event
+from database import setting
+import queryhelpers
+from queryhelpers import cacheStats
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# Upper bounds, in seconds, of the request duration histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PHASES = ('sql', 'template', 'bleach')
+
+
+class Metrics(object):
+    """
+    Process-wide request totals, per endpoint.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.buckets = {}
+        self.seconds = {}
+        self.phases = {}
+        self.queries = {}
+        self.lazy_loads = {}
+
+    def record(self, endpoint, duration, phases, statements):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.seconds[endpoint] = (self.seconds.get(endpoint, 0) +
+                                      duration)
+            buckets = self.buckets.setdefault(endpoint, [0] * len(BUCKETS))
+            for index, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    buckets[index] += 1
+            for phase in PHASES:
+                key = (endpoint, phase)
+                self.phases[key] = self.phases.get(key, 0) + phases[phase]
+            self.queries[endpoint] = (self.queries.get(endpoint, 0) +
+                                      len(statements))
+            self.lazy_loads[endpoint] = (
+                self.lazy_loads.get(endpoint, 0) +
+                sum(1 for statement in statements if statement['lazy']))
+
+    def render(self):
+        """
+        :return:
+        Metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            lines.append('# TYPE catalog_request_duration_seconds histogram')
+            for endpoint in sorted(self.requests):
+                for bound, count in zip(BUCKETS, self.buckets[endpoint]):
+                    lines.append('catalog_request_duration_seconds_bucket'
+                                 '{endpoint="%s",le="%s"} %d'
+                                 % (endpoint, bound, count))
+                lines.append('catalog_request_duration_seconds_bucket'
+                             '{endpoint="%s",le="+Inf"} %d'
+                             % (endpoint, self.requests[endpoint]))
+                lines.append('catalog_request_duration_seconds_sum'
+                             '{endpoint="%s"} %f'
+                             % (endpoint, self.seconds[endpoint]))
+                lines.append('catalog_request_duration_seconds_count'
+                             '{endpoint="%s"} %d'
+                             % (endpoint, self.requests[endpoint]))
+            lines.append('# TYPE catalog_request_phase_seconds_total counter')
+            for (endpoint, phase), seconds in sorted(self.phases.items()):
+                lines.append('catalog_request_phase_seconds_total'
+                             '{endpoint="%s",phase="%s"} %f'
+                             % (endpoint, phase, seconds))
+            lines.append('# TYPE catalog_sql_queries_total counter')
+            for endpoint, count in sorted(self.queries.items()):
+                lines.append('catalog_sql_queries_total{endpoint="%s"} %d'
+                             % (endpoint, count))
+            lines.append('# TYPE catalog_sql_lazy_loads_total counter')
+            for endpoint, count in sorted(self.lazy_loads.items()):
+                lines.append('catalog_sql_lazy_loads_total{endpoint="%s"} %d'
+                             % (endpoint, count))
+        stats = cacheStats()
+        lines.append('# TYPE catalog_cache_hits_total counter')
+        lines.append('catalog_cache_hits_total %d' % stats['hits'])
+        lines.append('# TYPE catalog_cache_misses_total counter')
+        lines.append('catalog_cache_misses_total %d' % stats['misses'])
+        return '\n'.join(lines) + '\n'
+
+
+def current():
+    """
+    :return:
+    The current request's record, or None outside an instrumented request.
+    """
+    if has_request_context():
+        return getattr(g, 'instrumentation', None)
+    return None
+
+
+def timed(phase, f):
+    """
+    Wrap f so that its duration is added to phase of the current request.
+    Nested calls, e.g. included templates, are only counted once.
+    """
+    def wrapper(*args, **kwargs):
+        record = current()
+        if record is None or record['depth'].get(phase):
+            return f(*args, **kwargs)
+        record['depth'][phase] = True
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            record['phases'][phase] += time.time() - start
+            record['depth'][phase] = False
+    wrapper.__name__ = f.__name__
+    wrapper.__doc__ = f.__doc__
+    return wrapper
+
+
+def isLazyLoad():
+    """
+    :return:
+    True when the calling SQL statement was emitted by a lazy loader.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if (code.co_name in ('_load_for_state', '_emit_lazyload') and
+                code.co_filename.endswith('strategies.py')):
+            return True
+        frame = frame.f_back
+    return False
+
+
+def instrumentEngine(engine):
+    """
+    Record every statement executed on engine during a request.
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def beforeExecute(conn, cursor, statement, parameters, context,
+                      executemany):
+        if current() is not None:
+            conn.info.setdefault('instrumentation_start', []).append(
+                time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def afterExecute(conn, cursor, statement, parameters, context,
+                     executemany):
+        record = current()
+        if record is None or not conn.info.get('instrumentation_start'):
+            return
+        duration = time.time() - conn.info['instrumentation_start'].pop()
+        record['phases']['sql'] += duration
+        record['statements'].append({'statement': statement,
+                                     'duration': duration,
+                                     'lazy': isLazyLoad()})
+
+
+class TimedTemplate(Template):
+    """
+    Jinja template whose rendering time is recorded.
+    """
+    def render(self, *args, **kwargs):
+        return timed('template', super(TimedTemplate, self).render)(
+            *args, **kwargs)
+
+
+def timeCleaner():
+    """
+    Record the time spent in the Cleaner shared by queryhelpers.clean.
+    Only that instance is wrapped, and only once per process, so other
+    users of bleach and later instrument calls are unaffected.
+    """
+    cleaner = queryhelpers.cleaner
+    if 'clean' not in vars(cleaner):
+        cleaner.clean = timed('bleach', cleaner.clean)
+
+
+def instrument(app, engines):
+    """
+    Enable instrumentation on app and the given engines,
+    and serve the collected metrics at /_metrics.
+    :param app: (Flask) application
+    :param engines: (list) Engine objects to record statements from
+    :return:
+    Metrics object collecting the totals.
+    """
+    metrics = Metrics()
+    slow = setting('CATALOG_SLOW_REQUEST_MS', 500) / 1000.0
+    sample = setting('CATALOG_PROFILE_SAMPLE', 0.0)
+    for engine in engines:
+        instrumentEngine(engine)
+    app.jinja_env.template_class = TimedTemplate
+    timeCleaner()
+
+    @app.before_request
+    def startRequest():
+        g.instrumentation = {'start': time.time(),
+                             'phases': dict.fromkeys(PHASES, 0.0),
+                             'depth': {},
+                             'statements': [],
+                             'profile': None}
+        if sample and random.random() < sample:
+            g.instrumentation['profile'] = cProfile.Profile()
+            g.instrumentation['profile'].enable()
+
+    @app.after_request
+    def finishRequest(response):
+        record = current()
+        if record is None:
+            return response
+        duration = time.time() - record['start']
+        if record['profile'] is not None:
+            record['profile'].disable()
+        endpoint = request.endpoint or 'unknown'
+        metrics.record(endpoint, duration, record['phases'],
+                       record['statements'])
+        if duration >= slow:
+            logSlowRequest(app, duration, record)
+        return response
+
+    @app.route('/_metrics')
+    def PrometheusMetrics():
+        """
+        Request metrics in the Prometheus text format.
+        """
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+    return metrics
+
+
+def logSlowRequest(app, duration, record):
+    """
+    Log the phases and statements of a slow request, and its profile
+    if it was sampled.
+    """
+    lines = ['Slow request: %s %s took %.1fms (%s)' % (
+        request.method, request.full_path.rstrip('?'), duration * 1000,
+        ', '.join('%s %.1fms' % (phase, record['phases'][phase] * 1000)
+                  for phase in PHASES))]
+    for statement in record['statements']:
+        lines.append('  %.1fms%s %s' % (statement['duration'] * 1000,
+                                        ' (lazy load)' if statement['lazy']
+                                        else '',
+                                        ' '.join(statement['statement']
+                                                 .split())))
+    if record['profile'] is not None:
+        output = StringIO()
+        stats = pstats.Stats(record['profile'], stream=output)
+        stats.sort_stats('cumulative').print_stats(25)
+        lines.append(output.getvalue())
+    app.logger.warning('\n'.join(lines))
@@ -0,0 +1,144 @@
+"""
+JSON encoding and compression for the API routes.
+dumps uses orjson when it is installed and the standard library
+otherwise. Both produce compact UTF-8 output with sorted keys and
+unescaped non-ASCII text, so a response has the same bytes whichever
+encoder built it.
+
+CATALOG_JSON_ENCODER        'orjson' or 'stdlib', default the fastest
+                            one installed
+CATALOG_COMPRESS_MIN_BYTES  smallest JSON body compressed with brotli
+                            (if installed) or gzip, 0 to disable (1024)
+"""
+import gzip
+import io
+import json
+from flask import Response, request
+from database import setting
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODER = setting('CATALOG_JSON_ENCODER', 'orjson' if orjson else 'stdlib')
+COMPRESS_MIN_BYTES = setting('CATALOG_COMPRESS_MIN_BYTES', 1024)
+
+
+def dumps(obj):
+    """
+    :param obj: JSON-serializable value
+    :return:
+    compact utf-8 encoded JSON
+    """
+    if ENCODER == 'orjson':
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=False).encode('utf-8')
+
+
+def jsonResponse(**kwargs):
+    """
+    Same document as flask.jsonify(**kwargs), without the whitespace.
+    :return:
+    application/json Response
+    """
+    return Response(dumps(kwargs), mimetype='application/json')
+
+
+class CatalogEncoder(object):
+    """
+    Encodes the rows of queryhelpers.catalogExportQuery one at a time
+    into the document jsonResponse(categories=[...serialize_items])
+    would build, so the catalog never has to be held in memory.
+    Rows are (category id, name, label, item_count, item id, name,
+    label, description), with a NULL item for empty categories.
+    """
+    def __init__(self):
+        self.category = None
+        self.items = 0
+
+    def start(self):
+        return b'{"categories":['
+
+    def row(self, row):
+        """
+        :param row: one row of catalogExportQuery
+        :return:
+        encoded bytes to append to the previous chunks
+        """
+        chunk = b''
+        if self.category is None or row[0] != self.category[0]:
+            if self.category is not None:
+                chunk = self.closeCategory() + b','
+            self.category = row[:4]
+            self.items = 0
+            chunk += (b'{"id":' + dumps(row[0]) + b',"item_count":' +
+                      dumps(row[3]) + b',"items":[')
+        if row[4] is not None:
+            chunk += (b',' if self.items else b'') + dumps({
+                'id': row[4], 'name': row[5], 'label': row[6],
+                'description': row[7]})
+            self.items += 1
+        return chunk
+
+    def closeCategory(self):
+        return (b'],"label":' + dumps(self.category[2]) + b',"name":' +
+                dumps(self.category[1]) + b'}')
+
+    def end(self):
+        chunk = self.closeCategory() if self.category is not None else b''
+        return chunk + b']}'
+
+
+def compress(data, encoding):
+    """
+    :param data: (bytes) response body
+    :param encoding: (string) 'br' or 'gzip'
+    :return:
+    compressed body
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def compressResponse(response):
+    """
+    after_request handler compressing JSON bodies of at least
+    COMPRESS_MIN_BYTES for clients that accept it. Streamed responses
+    are left alone.
+    :param response: (Response)
+    :return:
+    response
+    """
+    if (not COMPRESS_MIN_BYTES or response.status_code != 200 or
+            response.mimetype != 'application/json' or
+            response.is_streamed or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br'] > 0:
+        encoding = 'br'
+    elif accepted['gzip'] > 0:
+        encoding = 'gzip'
+    else:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # The compressed body is a different representation of the same
+    # content, so its validator can only be weak.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,72 @@
+"""
+Alembic environment. Migrations run against the database configured
+for the app, see database.py, and compare against the models in setup.py.
+"""
+from logging.config import fileConfig
+import os
+import sys
+from alembic import context
+
+# Alembic does not put the repository root on the path.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import createEngine  # noqa: E402
+from setup import Base  # noqa: E402
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+target_metadata = Base.metadata
+
+
+def includeObject(obj, name, type_, reflected, compare_to):
+    """
+    Leave the FTS5 search index and its shadow tables, which have no
+    model, out of autogenerate; revision 5c9a0e7b2d64 creates them.
+    """
+    return not (type_ == 'table' and name.startswith('item_search'))
+
+
+def run_migrations_offline():
+    """
+    Emit the migration SQL instead of running it.
+    """
+    context.configure(url=str(createEngine().url),
+                      target_metadata=target_metadata,
+                      include_object=includeObject,
+                      literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    """
+    Run the migrations on the connection passed in
+    config.attributes['connection'], as setup.createSchema does, or on
+    one from createEngine.
+    """
+    connection = config.attributes.get('connection')
+    if connection is not None:
+        runMigrations(connection)
+        return
+    with createEngine().connect() as connection:
+        runMigrations(connection)
+
+
+def runMigrations(connection):
+    """
+    :param connection: (Connection) database to migrate
+    """
+    context.configure(connection=connection,
+                      target_metadata=target_metadata,
+                      include_object=includeObject,
+                      # SQLite can only alter tables by copying them.
+                      render_as_batch=connection.dialect.name == 'sqlite')
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,37 @@
+"""add listing indexes
+
+Index the columns the listing and lookup queries filter and sort on:
+item lists by category newest first, items by owner, and category and
+item names compared in lower case.
+
+Revision ID: 49cea9b3b84b
+Revises: 
+Create Date: 2026-10-18 17:32:59.226296
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '49cea9b3b84b'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_item_category_id_id', 'item',
+                    ['category_id', sa.text('id DESC')])
+    op.create_index('ix_item_user_id', 'item', ['user_id'])
+    op.create_index('ix_item_category_id_lower_name', 'item',
+                    ['category_id', sa.text('lower(name)')])
+    op.create_index('ix_category_lower_name', 'category',
+                    [sa.text('lower(name)')])
+
+
+def downgrade():
+    op.drop_index('ix_category_lower_name', 'category')
+    op.drop_index('ix_item_category_id_lower_name', 'item')
+    op.drop_index('ix_item_user_id', 'item')
+    op.drop_index('ix_item_category_id_id', 'item')
@@ -0,0 +1,36 @@
+"""create item search
+
+Create the FTS5 full-text index over item labels and descriptions that
+setup.createSchema makes for new databases, and fill it from the item
+table. Existing copies are rebuilt, which also gives them the prefix
+indexes. SQLite only; other databases search with LIKE, see search.py.
+
+Revision ID: 5c9a0e7b2d64
+Revises: b3e8d5f0a417
+Create Date: 2026-10-18 19:40:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5c9a0e7b2d64'
+down_revision = 'b3e8d5f0a417'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TABLE IF EXISTS item_search')
+    op.execute("CREATE VIRTUAL TABLE item_search "
+               "USING fts5(label, description, prefix='2 3')")
+    op.execute('INSERT INTO item_search (rowid, label, description) '
+               'SELECT id, label, description FROM item')
+
+
+def downgrade():
+    # Databases made by setup.createSchema had item_search before this
+    # revision, so it is left in place.
+    pass
@@ -0,0 +1,34 @@
+"""add category item count
+
+Keep each category's number of items in category.item_count, so pages
+can show it without counting the items. The column starts from the
+current counts.
+
+Revision ID: 7d1f3c2a9e51
+Revises: 49cea9b3b84b
+Create Date: 2026-10-18 18:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d1f3c2a9e51'
+down_revision = '49cea9b3b84b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('category',
+                  sa.Column('item_count', sa.Integer(), nullable=False,
+                            server_default='0'))
+    op.execute('UPDATE category SET item_count = '
+               '(SELECT count(*) FROM item '
+               'WHERE item.category_id = category.id)')
+
+
+def downgrade():
+    with op.batch_alter_table('category') as batch_op:
+        batch_op.drop_column('item_count')
@@ -0,0 +1,37 @@
+"""compare names as stored
+
+Category and item names are written in lower case, so lookups compare
+them as is through the unique constraints on category.name and
+item (category_id, name). Names stored in any other case are lowered,
+and the lower(name) indexes, no longer used, are dropped.
+
+Revision ID: b3e8d5f0a417
+Revises: 7d1f3c2a9e51
+Create Date: 2026-10-18 19:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e8d5f0a417'
+down_revision = '7d1f3c2a9e51'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('UPDATE category SET name = lower(name) '
+               'WHERE name != lower(name)')
+    op.execute('UPDATE item SET name = lower(name) '
+               'WHERE name != lower(name)')
+    op.drop_index('ix_category_lower_name', 'category')
+    op.drop_index('ix_item_category_id_lower_name', 'item')
+
+
+def downgrade():
+    op.create_index('ix_item_category_id_lower_name', 'item',
+                    ['category_id', sa.text('lower(name)')])
+    op.create_index('ix_category_lower_name', 'category',
+                    [sa.text('lower(name)')])
@@ -0,0 +1,44 @@
+"""
+Cache of rendered HTML for the catalog pages.
+The category sidebar, item lists and item details are cached as
+fragments, so only the per-user navbar and flash messages are rendered
+on every request. Anonymous visitors are served whole cached pages.
+Every key embeds catalogVersion(), so any catalog write orphans them.
+
+CATALOG_PAGE_CACHE_BYTES    HTML kept per process, least recently
+                            used first out (33554432)
+"""
+import json
+from flask import Markup
+from cache import Cache, MemoryCacheBackend
+from database import setting
+from queryhelpers import catalogVersion
+
+# Bounded by size rather than entry count, since a page of items
+# can be a hundred times larger than a sidebar.
+pages = Cache(MemoryCacheBackend(
+    max_entries=None,
+    max_bytes=setting('CATALOG_PAGE_CACHE_BYTES', 33554432)))
+
+
+def htmlKey(name, *parts):
+    """
+    :param name: (string) 'page' or a fragment name
+    :param parts: values the HTML depends on besides the catalog
+    :return:
+    string cache key
+    """
+    # Encoded as JSON so that names containing ':' cannot collide.
+    return pages.key(name, catalogVersion(), json.dumps(parts))
+
+
+def fragment(name, render, *parts):
+    """
+    Return the HTML of a fragment, rendering it on a miss.
+    :param name: (string) fragment name, e.g. 'sidebar'
+    :param render: (function) returns the fragment's HTML
+    :param parts: values the fragment depends on besides the catalog
+    :return:
+    Markup to insert into a template.
+    """
+    return Markup(pages.fetch(htmlKey(name, *parts), render))
@@ -1,42 +1,389 @@
 """
 Commonly-used queries
+Read-only listings return CategoryRecord and ItemRecord objects built
+from column-only queries, not ORM entities. They have the attributes
+and serialize property the templates and JSON routes use, without an
+identity map or change tracking. Writes keep using the ORM, through
+getCategory and getCategoryItem.
+The listing queries are built without a session by the *Query
+functions, so that asgi.py can run the same SQL on its async driver.
+
+CATALOG_CACHE_PATH          SQLite file shared by every worker's cache,
+                            so they see each other's invalidations
+                            (unset: a cache per process)
 """
+from sqlalchemy import bindparam, func
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import Query
 from setup import Category, Item
+from cache import Cache, MemoryCacheBackend, SqliteCacheBackend
+from database import setting
 import bleach
+import re
+
+# Default and maximum number of items returned by one listing page.
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+
+def cacheBackend():
+    """
+    :return:
+    SqliteCacheBackend at CATALOG_CACHE_PATH, or a MemoryCacheBackend
+    when it is not set.
+    """
+    path = setting('CATALOG_CACHE_PATH', None)
+    if path:
+        return SqliteCacheBackend(path)
+    return MemoryCacheBackend()
+
+
+# Shared by every request in this process, and set up from the
+# environment here so that the CLI tools invalidate the same cache as
+# the app; see configureCache.
+cache = Cache(cacheBackend())
+
+# Building a Cleaner is most of the cost of bleach.clean, so reuse one.
+cleaner = bleach.Cleaner()
+# The only characters bleach.clean changes outside of markup: it escapes
+# these, drops NUL and replaces the other control characters but tab
+# and line feed.
+CLEANED = re.compile(u'[<>&\x00-\x08\x0b-\x1f]')
+
+# Point lookups are built and compiled to SQL once per process,
+# then only re-run with new bound parameters. Names are stored as
+# slugs (see slug), so they are compared as is, through the unique
+# indexes on category.name and item (category_id, name).
+bakery = baked.bakery()
+category_by_name = bakery(lambda session: session.query(Category))
+category_by_name += lambda query: query.filter(
+    Category.name == bindparam('name'))
+item_by_names = bakery(lambda session: session.query(Category, Item))
+item_by_names += lambda query: query.join(
+    Item, Item.category_id == Category.id)
+item_by_names += lambda query: query.filter(
+    Category.name == bindparam('category_name'),
+    Item.name == bindparam('item_name'))
+
+
+def clean(value):
+    """
+    Same result as bleach.clean(value), but text without any of the
+    CLEANED characters is returned as is instead of going through the
+    parser.
+    :param value: (string)
+    :return:
+    sanitized string
+    """
+    if not CLEANED.search(value):
+        return value
+    return cleaner.clean(value)
+
+
+def slug(value):
+    """
+    The form category and item names are stored in, from a label or a
+    URL segment in any case. URLs are built from the stored names, so
+    the URL segment of a lookup only goes through this once.
+    :param value: (string)
+    :return:
+    sanitized string in lower case
+    """
+    return clean(value).lower()
+
+
+def configureCache(backend, ttl=300):
+    """
+    Replace the process-wide cache, e.g. with a SqliteCacheBackend so that
+    several workers share entries and invalidations.
+    :param backend: (object) a cache backend from the cache module
+    :param ttl: (integer) default number of seconds entries are kept
+    """
+    global cache
+    cache = Cache(backend, ttl)
+
+
+def cacheStats():
+    """
+    :return:
+    dictionary of cache hit and miss counts for this process.
+    """
+    return cache.stats()
+
+
+def catalogVersion():
+    """
+    Version of the catalog contents, changed by every write.
+    Read from the cache backend, so it costs no database query.
+    :return:
+    string version
+    """
+    return cache.version('catalog')
+
+
+def invalidateCategories():
+    """
+    Drop the cached category list and every cached item list,
+    since item lists embed their category's name and label.
+    Call after a category is created, renamed or deleted.
+    """
+    cache.invalidate('categories')
+    cache.invalidate('catalog')
+
+
+def invalidateCategoryItems(category_id):
+    """
+    Drop the cached item lists of one category.
+    Call after an item is added to, changed in or removed from it.
+    :param category_id: (integer) Category.id
+    """
+    cache.invalidate('items:%s' % int(category_id))
+    cache.invalidate('counts')
+    cache.invalidate('catalog')
+
+
+def adjustItemCount(category_id, delta, session):
+    """
+    Add delta to a category's item count, in the session's transaction,
+    so the count commits or rolls back with the item write itself.
+    Call invalidateCategoryItems after the commit, as for any item write.
+    :param category_id: (integer) Category.id
+    :param delta: (integer) items added, negative for items removed
+    :param session: (DBSession) SQLAlchemy session
+    """
+    session.execute(Category.__table__.update()
+                    .where(Category.id == int(category_id))
+                    .values(item_count=Category.item_count + delta))
+
+
+def repairItemCounts(session):
+    """
+    Recount every category's items, fixing counts that drifted, e.g.
+    after items were written without adjustItemCount.
+    :param session: (DBSession) SQLAlchemy session
+    :return:
+    Number of categories whose count was wrong.
+    """
+    actual = (session.query(func.count(Item.id))
+              .filter(Item.category_id == Category.id)
+              .correlate(Category)
+              .as_scalar())
+    result = session.execute(Category.__table__.update()
+                             .where(Category.item_count != actual)
+                             .values(item_count=actual))
+    session.commit()
+    cache.invalidate('counts')
+    cache.invalidate('catalog')
+    return result.rowcount
+
+
+class CategoryRecord(object):
+    """
+    Read-only category, as listed in the sidebar and the JSON routes.
+    Categories of listed items are built without their item_count.
+    """
+    __slots__ = ('id', 'name', 'label', 'item_count')
+
+    def __init__(self, id, name, label, item_count=None):
+        self.id = id
+        self.name = name
+        self.label = label
+        self.item_count = item_count
+
+    @property
+    def serialize(self):
+        return {
+            'name': self.name,
+            'label': self.label,
+            'id': self.id,
+            'item_count': self.item_count,
+        }
+
+
+class ItemRecord(object):
+    """
+    Read-only item with its category, as listed on the catalog pages.
+    """
+    __slots__ = ('id', 'name', 'label', 'description', 'category_id',
+                 'user_id', 'category')
+
+    def __init__(self, id, name, label, description, category_id, user_id,
+                 category):
+        self.id = id
+        self.name = name
+        self.label = label
+        self.description = description
+        self.category_id = category_id
+        self.user_id = user_id
+        self.category = category
+
+    @property
+    def serialize(self):
+        return {
+            'name': self.name,
+            'label': self.label,
+            'description': self.description,
+            'id': self.id,
+        }
+
+
+CATEGORY_COLUMNS = (Category.id, Category.name, Category.label,
+                    Category.item_count)
+ITEM_COLUMNS = (Item.id, Item.name, Item.label, Item.description,
+                Item.category_id, Item.user_id, Category.name, Category.label)
+
+
+def itemRecords(rows):
+    """
+    Build records from rows of ITEM_COLUMNS, sharing one CategoryRecord
+    between the items of each category.
+    :param rows: iterable of ITEM_COLUMNS tuples
+    :return:
+    List of ItemRecord objects.
+    """
+    categories = {}
+    items = []
+    for (id, name, label, description, category_id, user_id,
+         category_name, category_label) in rows:
+        category = categories.get(category_id)
+        if category is None:
+            category = categories[category_id] = CategoryRecord(
+                category_id, category_name, category_label)
+        items.append(ItemRecord(id, name, label, description, category_id,
+                                user_id, category))
+    return items
 
 
 def getCategories(session):
     """
-    Retrieve all categories.
+    Retrieve all categories, with their item counts, through the cache.
+    :param session: (DBSession) SQLAlchemy session
+    :return:
+    List of CategoryRecord objects.
+    """
+    # Item writes change the counts but not the category item lists.
+    return cache.fetch(cache.key('categories', cache.generation('counts')),
+                       lambda: loadCategories(session))
+
+
+def loadCategories(session):
+    """
+    Retrieve all categories from the database.
     :param session: (DBSession) SQLAlchemy session
     :return:
-    List of Category objects.
+    List of CategoryRecord objects.
     """
     try:
-        categories = (session.query(Category)
-                      .order_by(Category.name)
-                      .all())
+        rows = categoriesQuery().with_session(session).all()
     except SQLAlchemyError:
         return False
-    return categories
+    return [CategoryRecord(*row) for row in rows]
+
+
+def categoriesQuery():
+    """
+    :return:
+    Query of CATEGORY_COLUMNS for every category, ordered by name.
+    """
+    return Query(CATEGORY_COLUMNS).order_by(Category.name)
+
+
+def categoryQuery(category_name):
+    """
+    :param category_name: (string) name in any case, as in a URL
+    :return:
+    Query of CATEGORY_COLUMNS for one category.
+    """
+    return (Query(CATEGORY_COLUMNS)
+            .filter(Category.name == slug(category_name)))
+
+
+def itemQuery(category_name, item_name):
+    """
+    :param category_name: (string) name in any case, as in a URL
+    :param item_name: (string) name in any case, as in a URL
+    :return:
+    Query of ITEM_COLUMNS for one item, found by both names at once.
+    """
+    return (Query(ITEM_COLUMNS)
+            .join(Category, Category.id == Item.category_id)
+            .filter(Category.name == slug(category_name),
+                    Item.name == slug(item_name)))
+
+
+def itemsQuery(category_id=None, after=None, limit=PAGE_SIZE):
+    """
+    :param category_id: (integer) only list this category's items
+    :param after: (integer) only list items with an id lower than this
+    :param limit: (integer) maximum number of items to list
+    :return:
+    Query of ITEM_COLUMNS for a page of items, newest first.
+    """
+    query = (Query(ITEM_COLUMNS)
+             .join(Category, Category.id == Item.category_id))
+    if category_id is not None:
+        query = query.filter(Item.category_id == category_id)
+    if after is not None:
+        query = query.filter(Item.id < after)
+    return query.order_by(Item.id.desc()).limit(pageLimit(limit))
+
+
+def catalogExportQuery():
+    """
+    :return:
+    Query of every category and its items, one row per item and one for
+    each empty category, ordered by category name and item id.
+    See jsonresponse.CatalogEncoder for the columns.
+    """
+    return (Query([Category.id, Category.name, Category.label,
+                   Category.item_count,
+                   Item.id, Item.name, Item.label, Item.description])
+            .outerjoin(Item, Item.category_id == Category.id)
+            .order_by(Category.name, Item.id))
+
+
+def pageLimit(limit):
+    """
+    Clamp a requested page size to PAGE_SIZE/MAX_PAGE_SIZE.
+    :param limit: (integer or None) requested number of items
+    :return:
+    integer between 1 and MAX_PAGE_SIZE
+    """
+    if not limit or limit < 1:
+        return PAGE_SIZE
+    return min(limit, MAX_PAGE_SIZE)
 
 
-def getItems(session):
+def nextCursor(items, limit):
     """
-       Retrieve all items.
+    Compute the keyset cursor for the page after items.
+    :param items: (list) page of Item objects, newest first
+    :param limit: (integer) page size used to fetch items
+    :return:
+    Item.id to pass as `after` for the next page, or None on the last page.
+    """
+    if items and len(items) == limit:
+        return items[-1].id
+    return None
+
+
+def getItems(session, after=None, limit=PAGE_SIZE):
+    """
+       Retrieve a page of items using keyset pagination on Item.id.
        :param session: (DBSession) SQLAlchemy session
+       :param after: (integer) only return items with an id lower than this
+       :param limit: (integer) maximum number of items to return
        :return:
-       List of Item objects from the greatest to lowest id
+       List of ItemRecord objects, with their category,
+       from the greatest to lowest id
        """
     try:
-        items = (session.query(Item)
-                 .filter(Item.category_id == Category.id)
-                 .order_by(Item.id.desc())
-                 .all())
+        rows = itemsQuery(None, after, limit).with_session(session).all()
     except SQLAlchemyError:
         return False
-    return items
+    return itemRecords(rows)
 
 
 def getCategory(category_name, session):
@@ -48,47 +395,63 @@ def getCategory(category_name, session):
        Category object.
         """
         try:
-            category = (session.query(Category)
-                        .filter_by(name=bleach.clean(category_name))
+            category = (category_by_name(session)
+                        .params(name=slug(category_name))
                         .one())
         except SQLAlchemyError:
             return False
         return category
 
 
-def getCategoryItems(category_id, session):
+def getCategoryItems(category_id, session, after=None, limit=PAGE_SIZE):
+    """
+    Retrieve a page of a category's items through the cache.
+    :param category_id: (integer)
+    :param session: (DBSession) SQLAlchemy session
+    :param after: (integer) only return items with an id lower than this
+    :param limit: (integer) maximum number of items to return
+    :return:
+   List of ItemRecord objects, with their category,
+   from the greatest to lowest id
+    """
+    key = cache.key('items:%s' % int(category_id),
+                    cache.generation('categories'), after, pageLimit(limit))
+    return cache.fetch(key, lambda: loadCategoryItems(
+        category_id, session, after, limit))
+
+
+def loadCategoryItems(category_id, session, after=None, limit=PAGE_SIZE):
     """
-    Retrieve a category's items based on category id.
+    Retrieve a page of a category's items from the database.
     :param category_id: (integer)
     :param session: (DBSession) SQLAlchemy session
+    :param after: (integer) only return items with an id lower than this
+    :param limit: (integer) maximum number of items to return
     :return:
-   Category object.
+   List of ItemRecord objects, with their category,
+   from the greatest to lowest id
     """
     try:
-        items = (session.query(Item)
-                 .filter_by(category_id=category_id)
-                 .filter(Item.category_id == Category.id)
-                 .order_by(Item.id.desc())
-                 .all())
+        rows = (itemsQuery(category_id, after, limit).with_session(session)
+                .all())
     except SQLAlchemyError:
         return False
-    return items
+    return itemRecords(rows)
 
 
-def getItem(category_id, item_name, session):
+def getCategoryItem(category_name, item_name, session):
     """
-    Retrieve item based on category id and item name.
-    :param category_id: (integer) Category.id
-    :param item_name: (string) Item.name
+    Retrieve an item and its category by both names, in one query.
+    :param category_name: (string) Category.name in any case, as in a URL
+    :param item_name: (string) Item.name in any case, as in a URL
     :param session: (DBSession) SQLAlchemy session
     :return:
-    Item object.
+    (Category, Item) tuple, or (False, False) when there is no such item.
     """
     try:
-        item = (session.query(Item)
-                .filter_by(category_id=category_id,
-                           name=bleach.clean(item_name.lower()))
-                .one())
+        return tuple(item_by_names(session)
+                     .params(category_name=slug(category_name),
+                             item_name=slug(item_name))
+                     .one())
     except SQLAlchemyError:
-        return False
-    return item
+        return False, False
@@ -0,0 +1,160 @@
+"""
+Full-text search over Item.label and Item.description.
+On SQLite the text lives in the FTS5 table item_search, whose rowid is
+Item.id. addItem and deleteItem keep it in sync; run `python search.py`
+to build it for an existing database.
+"""
+import re
+from sqlalchemy import or_, text
+from sqlalchemy.exc import SQLAlchemyError
+from setup import Category, Item, ITEM_SEARCH_DDL
+from queryhelpers import (PAGE_SIZE, ITEM_COLUMNS, cache, itemRecords,
+                          pageLimit)
+
+# Ranking reads every match of each word, so only this many of the
+# newest matches are ranked; later pages list older matches newest first.
+RANKED_MATCHES = 1000
+RANKED_QUERY = text(
+    'SELECT rowid FROM (SELECT rowid, rank FROM item_search '
+    'WHERE item_search MATCH :match ORDER BY rowid DESC LIMIT %d) '
+    'ORDER BY rank LIMIT :limit OFFSET :offset' % RANKED_MATCHES)
+NEWEST_QUERY = text(
+    'SELECT rowid FROM item_search WHERE item_search MATCH :match '
+    'ORDER BY rowid DESC LIMIT :limit OFFSET :offset')
+
+
+def hasIndex(session):
+    """
+    :param session: (DBSession) SQLAlchemy session
+    :return:
+    True when the database supports the FTS5 index.
+    """
+    return session.get_bind().dialect.name == 'sqlite'
+
+
+def matchExpression(query):
+    """
+    Turn free text into an FTS5 query matching every word, and the last
+    one, which may still be being typed, as a prefix.
+    Quoting each word keeps FTS5 operators in user input inert.
+    :param query: (string) search text
+    :return:
+    FTS5 MATCH expression, or None if query has no words.
+    """
+    words = ['"%s"' % word for word in re.findall(r'\w+', query, re.UNICODE)]
+    if not words:
+        return None
+    words[-1] += '*'
+    return ' '.join(words)
+
+
+def indexItem(item, session):
+    """
+    Add or refresh an item in the search index. Runs in the session's
+    transaction, so call it after a flush and before the commit.
+    :param item: (Item) flushed Item object
+    :param session: (DBSession) SQLAlchemy session
+    """
+    if not hasIndex(session):
+        return
+    unindexItem(item.id, session)
+    session.execute(text('INSERT INTO item_search (rowid, label, description) '
+                         'VALUES (:id, :label, :description)'),
+                    {'id': item.id, 'label': item.label,
+                     'description': item.description})
+
+
+def unindexItem(item_id, session):
+    """
+    Remove an item from the search index.
+    :param item_id: (integer) Item.id
+    :param session: (DBSession) SQLAlchemy session
+    """
+    if not hasIndex(session):
+        return
+    session.execute(text('DELETE FROM item_search WHERE rowid = :id'),
+                    {'id': item_id})
+
+
+def rebuildIndex(session):
+    """
+    Recreate the search index from the item table, and change the
+    catalog version so that cached search results are dropped.
+    :param session: (DBSession) SQLAlchemy session
+    :return:
+    Number of indexed items.
+    """
+    session.execute(text('DROP TABLE IF EXISTS item_search'))
+    session.execute(text(ITEM_SEARCH_DDL))
+    result = session.execute(text(
+        'INSERT INTO item_search (rowid, label, description) '
+        'SELECT id, label, description FROM item'))
+    session.commit()
+    cache.invalidate('catalog')
+    return result.rowcount
+
+
+def matchIds(session, query, match, limit, offset):
+    """
+    Run one of the item_search queries.
+    :param session: (DBSession) SQLAlchemy session
+    :param query: (TextClause) RANKED_QUERY or NEWEST_QUERY
+    :param match: (string) FTS5 MATCH expression
+    :param limit: (integer) maximum number of ids to return
+    :param offset: (integer) number of matches to skip
+    :return:
+    List of the matching Item.id values, in the query's order.
+    """
+    if not limit:
+        return []
+    return [row[0] for row in session.execute(
+        query, {'match': match, 'limit': limit, 'offset': offset})]
+
+
+def searchItems(query, session, page=1, limit=PAGE_SIZE):
+    """
+    Retrieve a page of items matching query, best matches first among
+    the newest RANKED_MATCHES, then newest first.
+    :param query: (string) search text
+    :param session: (DBSession) SQLAlchemy session
+    :param page: (integer) 1-based page number
+    :param limit: (integer) maximum number of items to return
+    :return:
+    List of ItemRecord objects with their category.
+    """
+    limit = pageLimit(limit)
+    offset = (max(page, 1) - 1) * limit
+    match = matchExpression(query)
+    if match is None:
+        return []
+    items = (session.query(*ITEM_COLUMNS)
+             .join(Category, Category.id == Item.category_id))
+    try:
+        if not hasIndex(session):
+            pattern = '%%%s%%' % re.sub(r'([\\%_])', r'\\\1', query)
+            return itemRecords(
+                items.filter(or_(Item.label.ilike(pattern, escape='\\'),
+                                 Item.description.ilike(pattern,
+                                                        escape='\\')))
+                .order_by(Item.id.desc())
+                .offset(offset)
+                .limit(limit)
+                .all())
+        ranked = max(0, min(limit, RANKED_MATCHES - offset))
+        ids = matchIds(session, RANKED_QUERY, match, ranked, offset)
+        if len(ids) == ranked < limit:
+            ids += matchIds(session, NEWEST_QUERY, match, limit - ranked,
+                            offset + ranked)
+        if not ids:
+            return []
+        by_id = dict((item.id, item) for item in
+                     itemRecords(items.filter(Item.id.in_(ids))))
+    except SQLAlchemyError:
+        return False
+    return [by_id[item_id] for item_id in ids if item_id in by_id]
+
+
+if __name__ == '__main__':
+    from database import createEngine, makeSessionFactory
+    session = makeSessionFactory(createEngine())()
+    print "Indexed %d items." % rebuildIndex(session)
@@ -0,0 +1,98 @@
+"""
+Server-side sessions. The session cookie carries only a random id, and
+the session data is kept in a cache backend (see cache.py), so requests
+do not ship the login details back and forth and a session can be ended
+on the server.
+
+CATALOG_SESSION_PATH        SQLite file shared by every worker's
+                            sessions, default in-process memory
+CATALOG_SESSION_TTL         seconds a session is kept after its last
+                            change (86400)
+"""
+import binascii
+import os
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from cache import MemoryCacheBackend, SqliteCacheBackend
+from database import setting
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """
+    Session data, marked as modified whenever it changes.
+    """
+    def __init__(self, initial=None, sid=None, new=False):
+        def onUpdate(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, onUpdate)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Keeps each session in backend under its id for ttl seconds.
+    Empty sessions are neither stored nor given a cookie.
+    """
+    def __init__(self, backend, ttl=86400):
+        self.backend = backend
+        self.ttl = ttl
+
+    def key(self, sid):
+        return 'session:%s' % sid
+
+    def newId(self):
+        return binascii.hexlify(os.urandom(32)).decode('ascii')
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            data = self.backend.get(self.key(sid))
+            if data is not None:
+                return ServerSession(data, sid)
+        return ServerSession(sid=self.newId(), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                self.backend.delete(self.key(session.sid))
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+        if session.modified:
+            self.backend.set(self.key(session.sid), dict(session), self.ttl)
+        if session.new:
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=self.get_expiration_time(app,
+                                                                 session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+    def regenerate(self, session):
+        """
+        Move session to a new id and end the old one, in every worker
+        sharing the backend. Called on login and logout so that an id
+        seen before either cannot be used after it.
+        :param session: (ServerSession) the current session
+        """
+        self.backend.delete(self.key(session.sid))
+        session.sid = self.newId()
+        session.new = True
+        session.modified = True
+
+
+def sessionBackend():
+    """
+    :return:
+    SqliteCacheBackend at CATALOG_SESSION_PATH, or a MemoryCacheBackend
+    when it is not set.
+    """
+    path = setting('CATALOG_SESSION_PATH', None)
+    if path:
+        return SqliteCacheBackend(path, max_entries=100000)
+    return MemoryCacheBackend(max_entries=100000)
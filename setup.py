@@ -1,8 +1,8 @@
-from sqlalchemy import (Column, ForeignKey, Integer,
-                        String, Boolean, UniqueConstraint)
+import os
+from sqlalchemy import (Column, ForeignKey, Integer, String, Boolean,
+                        UniqueConstraint, Index, DDL, event)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
 
 Base = declarative_base()
 
@@ -22,11 +22,16 @@ class Category(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(100), unique=True, nullable=False)
     label = Column(String(100), nullable=False)
-    items = relationship("Item", backref="category")
+    # Maintained by every item write, see queryhelpers.adjustItemCount.
+    item_count = Column(Integer, nullable=False, default=0,
+                        server_default='0')
+    # In id order, as catalogExportQuery lists them.
+    items = relationship("Item", backref="category", order_by="Item.id")
 
     def __init__(self, name):
         self.label = name
         self.name = name.lower()
+        self.item_count = 0
 
     @property
     def serialize(self):
@@ -34,6 +39,7 @@ class Category(Base):
             'name': self.name,
             'label': self.label,
             'id': self.id,
+            'item_count': self.item_count,
         }
 
     @property
@@ -43,6 +49,7 @@ class Category(Base):
             'name': self.name,
             'label': self.label,
             'id': self.id,
+            'item_count': self.item_count,
             'items': items
 
         }
@@ -55,7 +62,8 @@ class Item(Base):
     label = Column(String(200), nullable=False)
     description = Column(String)
     category_id = Column(Integer, ForeignKey("category.id"), nullable=False)
-    user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("user.id"), nullable=False,
+                     index=True)
     __table_args__ = (
         UniqueConstraint('category_id', 'name',  name='unique_index_1'),
     )
@@ -75,5 +83,40 @@ class Item(Base):
         }
 
 
-engine = create_engine('sqlite:///catalog.db')
-Base.metadata.create_all(engine)
+# Listings filter by category and page newest first. Lookups by name use
+# the unique constraints above, since names are stored in lower case.
+# Existing databases get these through migrations/.
+Index('ix_item_category_id_id', Item.category_id, Item.id.desc())
+
+# Full-text index over Item.label and Item.description, see search.py.
+# The 2 and 3 character prefixes of every word are indexed too, so that
+# short prefix searches do not scan every matching word.
+ITEM_SEARCH_DDL = ("CREATE VIRTUAL TABLE IF NOT EXISTS item_search "
+                   "USING fts5(label, description, prefix='2 3')")
+event.listen(Item.__table__, 'after_create',
+             DDL(ITEM_SEARCH_DDL).execute_if(dialect='sqlite'))
+
+
+def createSchema(engine):
+    """
+    Create the tables on a new database. Nothing creates them on import,
+    so run this once, with python setup.py or flask init-db.
+    :param engine: (Engine) database to create the tables in
+    """
+    from alembic import command
+    from alembic.config import Config
+    Base.metadata.create_all(engine)
+    # The new tables already have every migration's changes. Stamp them
+    # through engine, not the database migrations/env.py would open.
+    root = os.path.dirname(os.path.abspath(__file__))
+    config = Config(os.path.join(root, 'alembic.ini'))
+    config.set_main_option('script_location',
+                           os.path.join(root, 'migrations'))
+    with engine.begin() as connection:
+        config.attributes['connection'] = connection
+        command.stamp(config, 'head')
+
+
+if __name__ == '__main__':
+    from database import createEngine
+    createSchema(createEngine())
@@ -1,43 +1,719 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import SQLAlchemyError
-from setup import Base, User
+import base64
+import gzip
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from setup import Base, User, Category, Item
+from database import (createEngine, makeSessionFactory,
+                      sqliteStatementTimeout)
+import json
+import bleach
+import api
+import assets
+import queryhelpers
+import search
+import bulk
+import pagecache
+import cache
+import googleauth
+import jsonresponse
 
-engine = create_engine('sqlite:///catalog.db', pool_pre_ping=True)
+# As when deploying, the app only reads the build's manifest.
+assets.build()
+api.configureApp()
+engine = createEngine()
 Base.metadata.bind = engine
-DBSession = sessionmaker(bind=engine)
+DBSession = makeSessionFactory(engine)
 session = DBSession()
-test_user = {"email": "test@test.com", "password": "password"}
+test_user = {"email": "test@test.com", "username": "Test User"}
+test_category = "Test Category"
+test_items = ["Test Item 1", "Test Item 2", "Test Item 3"]
+
+
+class QueryCounter(object):
+    """
+    Count the SQL statements executed on an engine inside a with block.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+class StubGoogleHandler(BaseHTTPRequestHandler):
+    """
+    Answers the Google OAuth calls made by googleauth with canned JSON
+    for test_user, over keep-alive connections.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        path = self.path.split('?')[0]
+        self.server.calls.append(path)
+        claims = base64.urlsafe_b64encode(json.dumps({'sub': '42'}))
+        body = json.dumps({
+            # A new access token for every code exchange, as Google does.
+        '/token': {'access_token': 'token%d' % len(self.server.calls),
+                   'id_token': 'x.%s.y' % claims},
+            '/tokeninfo': {'user_id': '42',
+                           'issued_to': api.clientSecrets()['client_id']},
+            '/userinfo': {'name': test_user['username'],
+                          'email': test_user['email']},
+            '/revoke': {},
+        }[path])
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class StubGoogle(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
 
 
 # Test User
 # Run suite of tests.
 def run_tests():
     cleanup()
+    test_lazy_imports()
     # Primary tests
     create_user(test_user)
+    # Query count tests
+    create_test_items()
+    test_query_counts()
+    test_query_plans()
+    test_cache_invalidation()
+    test_sqlite_cache()
+    test_item_counts()
+    test_catalog_export()
+    test_conditional_get()
+    test_search()
+    test_page_cache()
+    test_json_compression()
+    test_bulk_import()
+    test_connections_released()
+    test_statement_timeout()
+    test_app_configuration()
+    test_assets()
+    test_server_sessions()
+    test_google_login()
+    test_instrumentation()
     cleanup()
 
 
 def cleanup():
-    new_user = session.query(User).filter_by(email=test_user["email"]).one()
-    session.delete(new_user)
+    category = session.query(Category).filter_by(
+        name=test_category.lower()).first()
+    if category:
+        for item in session.query(Item).filter_by(category_id=category.id):
+            search.unindexItem(item.id, session)
+            session.delete(item)
+        session.delete(category)
+    session.query(User).filter_by(email=test_user["email"]).delete(
+        synchronize_session=False)
     session.commit()
 
 
 # Create user
 def create_user(user):
-    new_user = User(email=user["email"], password=user["password"])
+    new_user = User(email=user["email"], username=user["username"])
     session.add(new_user)
     session.commit()
     try:
         created_user = (session.query(User)
                         .filter_by(email=user["email"])
-                        .exists())
+                        .one())
         print "."
     except SQLAlchemyError:
         print "Unable to create test user."
 
 
+def create_test_items():
+    user = session.query(User).filter_by(email=test_user["email"]).one()
+    category = Category(name=test_category)
+    session.add(category)
+    session.commit()
+    for label in test_items:
+        session.add(Item(name=label.lower(), label=label,
+                         description=label, category_id=category.id,
+                         user_id=user.id))
+    session.commit()
+
+
+# The OAuth libraries are not loaded until someone logs in.
+def test_lazy_imports():
+    assert 'requests' not in sys.modules
+    assert 'multiprocessing.pool' not in sys.modules
+    print "."
+
+
+# Listing pages must cost a constant number of queries,
+# no matter how many items they render.
+def test_query_counts():
+    client = api.app.test_client()
+    routes = [
+        ('/catalog', 2),
+        ('/catalog/%s/items' % test_category.lower(), 3),
+        ('/catalog/JSON', 1),
+        # Both names of an item URL are resolved by one joined lookup.
+        ('/catalog/%s/item/%s' % (test_category, test_items[0]), 1),
+        ('/catalog/%s/item/%s/JSON' % (test_category.upper(),
+                                        test_items[0]), 1),
+    ]
+    for url, expected in routes:
+        # Measure a cold cache.
+        queryhelpers.cache.backend.clear()
+        pagecache.pages.backend.clear()
+        with QueryCounter(api.engine) as counter:
+            response = client.get(url)
+            response.get_data()
+        assert response.status_code == 200, url
+        assert counter.count == expected, (
+            "%s ran %d queries, expected %d" % (url, counter.count, expected))
+        print "."
+
+
+# Queries that read every row by design: the category list, and the
+# newest-first walk of item's primary key, which stops at its LIMIT.
+FULL_SCANS_ALLOWED = {'getCategories': ['category'], 'getItems': ['item']}
+# Queries that sort a bounded set: search ranks at most
+# search.RANKED_MATCHES matches.
+BOUNDED_SORTS = ['searchItems']
+
+
+# Every query helper must be served by an index, not a table scan or sort.
+def test_query_plans():
+    if engine.dialect.name != 'sqlite':
+        return
+    category = session.query(Category).filter_by(
+        name=test_category.lower()).one()
+    newest = session.query(Item).order_by(Item.id.desc()).first()
+    helpers = [
+        ('getCategories', lambda: queryhelpers.loadCategories(session)),
+        ('getItems', lambda: queryhelpers.getItems(session)),
+        ('getItems', lambda: queryhelpers.getItems(session, newest.id)),
+        ('getCategory', lambda: queryhelpers.getCategory(
+            test_category.upper(), session)),
+        ('getCategoryItems', lambda: queryhelpers.loadCategoryItems(
+            category.id, session)),
+        ('getCategoryItems', lambda: queryhelpers.loadCategoryItems(
+            category.id, session, newest.id)),
+        ('getCategoryItem', lambda: queryhelpers.getCategoryItem(
+            test_category.upper(), test_items[0].upper(), session)),
+        ('searchItems', lambda: search.searchItems("test item", session)),
+    ]
+    for name, helper in helpers:
+        statements = []
+
+        def record(conn, cursor, statement, parameters, *args):
+            statements.append((statement, parameters))
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            helper()
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        assert statements, name
+        connection = engine.raw_connection()
+        try:
+            for statement, parameters in statements:
+                cursor = connection.cursor()
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+                plan = [row[-1] for row in cursor.fetchall()]
+                for detail in plan:
+                    scan = re.match(r'SCAN (?:TABLE )?(\w+)', detail)
+                    assert ('VIRTUAL TABLE' in detail or not scan or
+                            scan.group(1) in FULL_SCANS_ALLOWED.get(name, [])
+                            ), (name, statement, plan)
+                    assert ('TEMP B-TREE' not in detail or
+                            name in BOUNDED_SORTS), (name, statement, plan)
+        finally:
+            connection.close()
+    print "."
+
+
+# Cached item lists must reflect writes made through addItem.
+def test_cache_invalidation():
+    category = session.query(Category).filter_by(
+        name=test_category.lower()).one()
+    before = queryhelpers.getCategoryItems(category.id, session)
+    cached = queryhelpers.getCategoryItems(category.id, session)
+    assert [i.id for i in before] == [i.id for i in cached]
+    user = session.query(User).filter_by(email=test_user["email"]).one()
+    test_items.append("Test Item 4")
+    new_item = api.addItem(Item(label=test_items[-1], description="",
+                                category_id=category.id, user_id=user.id),
+                           session)
+    after = queryhelpers.getCategoryItems(category.id, session)
+    assert after[0].id == new_item.id
+    assert len(after) == len(before) + 1
+    print "."
+
+
+# Hits and versions read from the shared cache file only write when the
+# entry's access time is stale, and the first time the epoch is drawn.
+def test_sqlite_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        backend = cache.SqliteCacheBackend(
+            os.path.join(directory, 'cache.db'), touch_interval=60)
+        backend.set('key', [1, 2])
+        connection = backend._connection()
+        changes = connection.total_changes
+        assert backend.get('key') == [1, 2]
+        assert backend.get('key') == [1, 2]
+        assert connection.total_changes == changes
+        connection.execute('UPDATE cache SET accessed = accessed - 120')
+        changes = connection.total_changes
+        assert backend.get('key') == [1, 2]
+        assert connection.total_changes == changes + 1
+        # Excess entries are evicted every evict_every sets, oldest first.
+        backend.max_entries = 3
+        backend.evict_every = 2
+        count = 'SELECT count(*) FROM cache'
+        for n in range(6):
+            backend.set('key%d' % n, n)
+            assert connection.execute(count).fetchone()[0] <= 4
+        assert backend.get('key5') == 5 and backend.get('key0') is None
+        # The epoch is written once, then read from the connection.
+        shared = cache.Cache(backend)
+        version = shared.version('catalog')
+        changes = connection.total_changes
+        assert shared.version('catalog') == version
+        assert connection.total_changes == changes
+        # Every entry point gets the shared cache from the environment.
+        os.environ['CATALOG_CACHE_PATH'] = os.path.join(directory, 'cache.db')
+        try:
+            backend = queryhelpers.cacheBackend()
+        finally:
+            del os.environ['CATALOG_CACHE_PATH']
+        assert isinstance(backend, cache.SqliteCacheBackend)
+        assert isinstance(queryhelpers.cacheBackend(),
+                          cache.MemoryCacheBackend)
+    finally:
+        shutil.rmtree(directory)
+    print "."
+
+
+# Category item counts are repaired from the items, and shown without
+# counting them.
+def test_item_counts():
+    category = session.query(Category).filter_by(
+        name=test_category.lower()).one()
+    # create_test_items added its items without counting them.
+    assert queryhelpers.repairItemCounts(session) >= 1
+    assert queryhelpers.repairItemCounts(session) == 0
+    session.refresh(category)
+    assert category.item_count == len(test_items)
+    client = api.app.test_client()
+    counts = dict((c['id'], c['item_count']) for c in json.loads(
+        client.get('/categories/JSON').data)['categories'])
+    assert counts[category.id] == len(test_items)
+    page = client.get('/catalog/%s/items' % category.name).data
+    assert '%s (%d)' % (test_category, len(test_items)) in page
+    # A category that is not offered is refused before any count changes.
+    item = session.query(Item).filter_by(category_id=category.id).first()
+    with client.session_transaction() as login_session:
+        login_session['user_id'] = item.user_id
+    for value in ['not a number', '-1']:
+        for url in ['/catalog/items/new', '/catalog/%s/item/%s/edit' % (
+                category.name, item.name)]:
+            response = client.post(url, data={'name': 'Moved',
+                                              'description': '',
+                                              'category': value})
+            assert response.status_code == 400, (url, value)
+    session.refresh(category)
+    session.refresh(item)
+    assert category.item_count == len(test_items)
+    assert item.label != 'Moved'
+    print "."
+
+
+# The streamed catalog is the document serialize_items would build.
+def test_catalog_export():
+    categories = session.query(Category).order_by(Category.name).all()
+    expected = jsonresponse.dumps(
+        {'categories': [c.serialize_items for c in categories]})
+    assert api.app.test_client().get('/catalog/JSON').data == expected
+    session.rollback()
+    print "."
+
+
+# Polling a JSON route with a current ETag must not touch the database.
+def test_conditional_get():
+    client = api.app.test_client()
+    url = '/catalog/%s/items/JSON' % test_category.lower()
+    etag = client.get(url).headers['ETag']
+    with QueryCounter(api.engine) as counter:
+        response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert counter.count == 0
+    category = session.query(Category).filter_by(
+        name=test_category.lower()).one()
+    queryhelpers.invalidateCategoryItems(category.id)
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    print "."
+
+
+# Anonymous page views are served from the page cache until a write,
+# while logged-in users and pending flashes still get a fresh page.
+def test_page_cache():
+    api.app.secret_key = api.app.secret_key or 'test'
+    client = api.app.test_client()
+    url = '/catalog/%s/items' % test_category.lower()
+    first = client.get(url).data
+    with QueryCounter(api.engine) as counter:
+        second = client.get(url).data
+    assert counter.count == 0
+    assert first == second
+    with client.session_transaction() as login_session:
+        login_session['username'] = test_user['username']
+        login_session['_flashes'] = [('message', 'Flashed.')]
+    page = client.get(url).data
+    assert test_user['username'] in page and 'Flashed.' in page
+    assert 'Flashed.' not in client.get(url).data
+    category = session.query(Category).filter_by(
+        name=test_category.lower()).one()
+    user = session.query(User).filter_by(email=test_user["email"]).one()
+    test_items.append("Test Item 7")
+    api.addItem(Item(label=test_items[-1], description="",
+                     category_id=category.id, user_id=user.id), session)
+    assert test_items[-1] in api.app.test_client().get(url).data
+    # Made-up item URLs are not found, and not cached.
+    entries = len(pagecache.pages.backend._entries)
+    client = api.app.test_client()
+    for url in ['/catalog/nope/item/nope', '/catalog/nope/item/nope/JSON',
+                '/catalog/%s/item/nope' % test_category.lower()]:
+        assert client.get(url).status_code == 404, url
+    assert len(pagecache.pages.backend._entries) == entries
+    print "."
+
+
+# JSON is compact, and compressed for clients that accept gzip
+# without losing conditional GETs.
+def test_json_compression():
+    client = api.app.test_client()
+    url = '/catalog/items/JSON?limit=100'
+    plain = client.get(url)
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.data == jsonresponse.dumps(json.loads(plain.data))
+    # Non-ASCII text is written as UTF-8, as orjson in asgi.py writes it.
+    assert jsonresponse.dumps({'label': u'caf\xe9'}) == (
+        b'{"label":"caf\xc3\xa9"}')
+    min_bytes = jsonresponse.COMPRESS_MIN_BYTES
+    jsonresponse.COMPRESS_MIN_BYTES = 1
+    compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    body = gzip.GzipFile(fileobj=io.BytesIO(compressed.data)).read()
+    assert body == plain.data
+    assert len(compressed.data) < len(plain.data)
+    response = client.get(url, headers={
+        'Accept-Encoding': 'gzip',
+        'If-None-Match': compressed.headers['ETag']})
+    assert response.status_code == 304
+    jsonresponse.COMPRESS_MIN_BYTES = min_bytes
+    print "."
+
+
+# Items added through addItem are searchable by label and description.
+def test_search():
+    results = search.searchItems("test ite", session)
+    assert test_items[-1] in [i.label for i in results]
+    client = api.app.test_client()
+    response = client.get('/catalog/search/JSON?q=test+item+4')
+    assert response.status_code == 200
+    assert [i['label'] for i in json.loads(response.data)['items']] == [
+        test_items[-1]]
+    assert search.matchExpression('test ite') == '"test" "ite"*'
+    # Rebuilding the index changes the ETags of cached search results.
+    version = queryhelpers.catalogVersion()
+    assert search.rebuildIndex(session) >= len(test_items)
+    assert queryhelpers.catalogVersion() != version
+    # Without FTS5, % and _ in the search text are matched literally.
+    hasIndex = search.hasIndex
+    search.hasIndex = lambda session: False
+    try:
+        assert search.searchItems("Test Item", session)
+        assert search.searchItems("Test_Item", session) == []
+        assert search.searchItems("%", session) == []
+    finally:
+        search.hasIndex = hasIndex
+    # A failing search is answered with no results or a 503, uncached.
+    searchItems = api.searchItems
+    api.searchItems = lambda *args: False
+    try:
+        assert client.get('/catalog/search?q=test').status_code == 200
+        response = client.get('/catalog/search/JSON?q=test')
+        assert response.status_code == 503
+        assert 'ETag' not in response.headers
+    finally:
+        api.searchItems = searchItems
+    print "."
+
+
+# Bulk imports insert valid rows and report the others by line.
+def test_bulk_import():
+    user = session.query(User).filter_by(email=test_user["email"]).one()
+    category = test_category.lower()
+    test_items.extend(["Test Item 5", "Test Item 6"])
+    lines = ['category,label,description',
+             '%s,Test Item 5,Imported' % category,
+             '%s,Test Item 1,Duplicate' % category,
+             'no such category,Test Item 6,',
+             '%s,Test Item 6,Imported' % category]
+    result = bulk.importItems(bulk.readRows(lines, 'csv'), session, user.id,
+                              batch_size=2)
+    assert result['inserted'] == 2, result
+    assert [e['line'] for e in result['errors']] == [3, 4], result
+    count = session.query(Category.item_count).filter_by(
+        name=category).scalar()
+    assert count == session.query(Item).filter(
+        Item.category.has(name=category)).count()
+    exported = list(bulk.exportItems(session, 'ndjson'))
+    assert json.loads(exported[-1])['label'] == "Test Item 6"
+    # Values of the wrong JSON type are reported per row.
+    lines = ['{"label": 123, "category": "%s"}' % category,
+             '{"label": "x", "category": ["%s"]}' % category]
+    result = bulk.importItems(bulk.readRows(lines, 'ndjson'), session,
+                              user.id)
+    assert result['inserted'] == 0, result
+    assert [e['line'] for e in result['errors']] == [1, 2], result
+    # Imported text is cleaned exactly as addItem's bleach.clean does.
+    for text in [u'a\x00b\rc\x01d\te\nf', u'<b>&</b>', u'plain']:
+        assert queryhelpers.clean(text) == bleach.clean(text), text
+    print "."
+
+
+# Every request returns its connection to the pool when it ends.
+def test_connections_released():
+    client = api.app.test_client()
+    for url in ['/catalog', '/catalog/JSON', '/catalog/items/JSON',
+                '/catalog/%s/items' % test_category.lower()]:
+        client.get(url).get_data()
+        assert api.engine.pool.checkedout() == 0, url
+    print "."
+
+
+# Statements are interrupted at the timeout, rows streamed after it are
+# not.
+def test_statement_timeout():
+    engine = create_engine('sqlite://')
+    sqliteStatementTimeout(engine, 50)
+    count = ('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 '
+             'FROM n WHERE i < %d) SELECT %s FROM n')
+    connection = engine.connect()
+    try:
+        rows = connection.execute(count % (100000, 'i'))
+        rows.fetchone()
+        time.sleep(0.1)
+        assert len(rows.fetchall()) == 99999
+        try:
+            connection.execute(count % (10 ** 12, 'count(*)'))
+            assert False, 'statement was not interrupted'
+        except OperationalError:
+            pass
+    finally:
+        connection.close()
+    print "."
+
+
+# configureApp configures the shared app once, and afterFork leaves no
+# connection shared with the parent process.
+def test_app_configuration():
+    assert api.configureApp() is api.app
+    assert api.app.secret_key
+    api.app.test_client().get('/catalog/JSON').get_data()
+    assert api.engine.pool.checkedin() > 0
+    api.afterFork()
+    assert api.engine.pool.checkedin() == 0
+    print "."
+
+
+# Pages link one hashed stylesheet, cached forever and served
+# precompressed, and nothing from third-party hosts.
+def test_assets():
+    client = api.app.test_client()
+    page = client.get('/categories').data
+    hrefs = re.findall(r'(?:href|src)="([^"]+\.(?:css|js))"', page)
+    assert len(hrefs) == 1 and re.match(r'/assets/app\.\w{10}\.css$',
+                                        hrefs[0]), hrefs
+    # Only fonts missing from assets/fonts/ come from Google Fonts,
+    # loaded without blocking rendering.
+    assert (re.findall(r'rel="preload" as="style" href="https://fonts\.'
+                       r'googleapis\.com/css\?family=(\w+)&amp;display=swap"',
+                       page) == assets.external_fonts)
+    assert 'fontawesome' not in page
+    response = client.get(hrefs[0], headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/css'
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    css = gzip.GzipFile(fileobj=io.BytesIO(response.data)).read()
+    assert css == client.get(hrefs[0]).data
+    assert client.get('/assets/main.css').status_code == 404
+    # A build made from other sources is reported, but not replaced
+    # at start-up; files of earlier builds are kept.
+    with open(assets.MANIFEST) as f:
+        data = json.load(f)
+    data['sources'] = 'stale'
+    with open(assets.MANIFEST, 'w') as f:
+        json.dump(data, f)
+    assert not assets.loadManifest()
+    with open(assets.MANIFEST) as f:
+        assert json.load(f)['sources'] == 'stale'
+    assets.build()
+    assert assets.loadManifest()
+    assert os.path.exists(os.path.join(assets.BUILD_DIR,
+                                       data['files']['app.css']))
+    print "."
+
+
+# The session cookie holds only an id, and logging out ends the
+# session for every client that presents the old id.
+def test_server_sessions():
+    client = api.app.test_client()
+    with client.session_transaction() as login_session:
+        login_session.update(username=test_user['username'],
+                             email=test_user['email'], user_id=1,
+                             is_admin=False, provider='test')
+    name = api.app.session_cookie_name
+    sid = [c.value for c in client.cookie_jar if c.name == name][0]
+    backend = api.app.session_interface.backend
+    assert len(sid) == 64
+    assert backend.get('session:' + sid)['user_id'] == 1
+    client.get('/disconnect')
+    assert backend.get('session:' + sid) is None
+    other = api.app.test_client()
+    other.set_cookie('localhost', name, sid)
+    with other.session_transaction() as login_session:
+        assert 'user_id' not in login_session
+    # A session that never saw the login page is refused, not a 500.
+    for url in ['/gconnect', '/gconnect?state=']:
+        response = api.app.test_client().post(url, data='code')
+        assert response.status_code == 401, url
+    print "."
+
+
+# gconnect and gdisconnect run the whole OAuth exchange against a stub.
+def test_google_login():
+    api.app.secret_key = api.app.secret_key or 'test'
+    server = StubGoogle(('127.0.0.1', 0), StubGoogleHandler)
+    server.calls = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    stub = 'http://127.0.0.1:%d' % server.server_port
+    urls = (googleauth.TOKEN_URL, googleauth.TOKENINFO_URL,
+            googleauth.USERINFO_URL, googleauth.REVOKE_URL)
+    # Stands in for client_secrets.json, which is not in the repository.
+    client_secrets = api.client_secrets
+    api.client_secrets = {'client_id': 'test-client-id',
+                          'client_secret': 'test-client-secret',
+                          'token_uri': stub + '/token'}
+    (googleauth.TOKEN_URL, googleauth.TOKENINFO_URL,
+     googleauth.USERINFO_URL, googleauth.REVOKE_URL) = (
+        stub + '/token', stub + '/tokeninfo', stub + '/userinfo',
+        stub + '/revoke')
+    try:
+        user = session.query(User).filter_by(email=test_user["email"]).one()
+        session.commit()
+        clients = []
+        # The second login checks its new token, but reuses the cached
+        # profile and user.
+        for expected_queries in (1, 0):
+            client = api.app.test_client()
+            client.get('/login')
+            with client.session_transaction() as login_session:
+                state = login_session['state']
+            with QueryCounter(api.engine) as counter:
+                response = client.post('/gconnect?state=%s' % state,
+                                       data='code')
+            assert response.data == 'Done!', response.data
+            assert counter.count == expected_queries, counter.count
+            with client.session_transaction() as login_session:
+                assert login_session['user_id'] == user.id
+            clients.append(client)
+        clients[0].get('/disconnect')
+        for n in range(50):
+            if '/revoke' in server.calls:
+                break
+            time.sleep(0.1)
+        assert sorted(server.calls) == ['/revoke', '/token', '/token',
+                                        '/tokeninfo', '/tokeninfo',
+                                        '/userinfo'], server.calls
+    finally:
+        (googleauth.TOKEN_URL, googleauth.TOKENINFO_URL,
+         googleauth.USERINFO_URL, googleauth.REVOKE_URL) = urls
+        api.client_secrets = client_secrets
+        server.shutdown()
+        server.server_close()
+    print "."
+
+
+def test_instrumentation():
+    from flask import Flask, render_template_string
+    from instrumentation import instrument, timeCleaner
+    app = Flask('instrumented')
+    metrics = instrument(app, [engine])
+
+    @app.route('/items')
+    def items():
+        return render_template_string('{{ items|length }}',
+                                      items=session.query(Item).all())
+    client = app.test_client()
+    assert client.get('/items').status_code == 200
+    text = client.get('/_metrics').data
+    assert 'catalog_sql_queries_total{endpoint="items"} 1' in text, text
+    assert 'phase="template"' in text
+    assert metrics.requests['items'] == 1
+    # Only the shared Cleaner is timed, and only once.
+    instrument(Flask('instrumented again'), [])
+    wrapped = queryhelpers.cleaner.clean
+    assert wrapped.__module__ == 'instrumentation'
+    assert vars(bleach.Cleaner)['clean'].__module__ == 'bleach.sanitizer'
+    timeCleaner()
+    assert queryhelpers.cleaner.clean is wrapped
+
+    @app.route('/clean')
+    def cleaned():
+        return queryhelpers.clean(u'<b>' * 1000)
+    assert client.get('/clean').status_code == 200
+    assert metrics.phases[('cleaned', 'bleach')] > 0
+    session.rollback()
+    print "."
+
+
 if __name__ == '__main__':
     run_tests()
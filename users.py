@@ -0,0 +1,87 @@
+"""
+User lookups for gconnect.
+Users are kept in an in-process cache by email, so a
+returning user logs in without touching the database, and a new or
+evicted one costs a single upsert.
+
+CATALOG_USER_CACHE_TTL      seconds a user record is trusted (300),
+                            bounding how long an is_admin change takes
+"""
+import sqlite3
+from sqlalchemy import text
+from cache import Cache, MemoryCacheBackend
+from database import setting
+from setup import User
+
+users = Cache(MemoryCacheBackend(max_entries=10000),
+              ttl=setting('CATALOG_USER_CACHE_TTL', 300))
+
+UPSERT = text('INSERT INTO "user" (email, username, is_admin) '
+              'VALUES (:email, :username, :is_admin) '
+              'ON CONFLICT (email) DO UPDATE SET email = excluded.email '
+              'RETURNING id, is_admin')
+
+
+def emailKey(email):
+    return users.key('user-email', email.encode('utf-8'))
+
+
+def cacheUser(record):
+    """
+    Store a user record under its email.
+    :param record: (dictionary) id, email and is_admin of a user
+    :return:
+    record
+    """
+    users.set(emailKey(record['email']), record)
+    return record
+
+
+def supportsUpsert(session):
+    """
+    :param session: (DBSession) SQLAlchemy session
+    :return:
+    True when the database has INSERT ... ON CONFLICT ... RETURNING.
+    """
+    dialect = session.get_bind().dialect.name
+    return (dialect == 'postgresql' or
+            (dialect == 'sqlite' and sqlite3.sqlite_version_info >= (3, 35)))
+
+
+def upsertUser(email, username, session):
+    """
+    Create the user with this email unless it exists, and return it.
+    :param email: (string)
+    :param username: (string) name stored for a new user
+    :param session: (DBSession) SQLAlchemy session
+    :return:
+    dictionary of the user's id, email and is_admin.
+    """
+    if supportsUpsert(session):
+        row = session.execute(UPSERT, {'email': email,
+                                       'username': username,
+                                       'is_admin': False}).fetchone()
+        session.commit()
+        return {'id': row[0], 'email': email, 'is_admin': bool(row[1])}
+    user = session.query(User).filter_by(email=email).first()
+    if user is None:
+        user = User(email=email, username=username)
+        session.add(user)
+        session.commit()
+    return {'id': user.id, 'email': email, 'is_admin': bool(user.is_admin)}
+
+
+def loginUser(email, username, session):
+    """
+    Find or create the user logging in with email.
+    :param email: (string)
+    :param username: (string) name stored for a new user
+    :param session: (DBSession) SQLAlchemy session
+    :return:
+    dictionary of the user's id, email and is_admin.
+    """
+    record = users.get(emailKey(email))
+    if record is None:
+        record = cacheUser(upsertUser(email, username, session))
+    return record
+
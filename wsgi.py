@@ -0,0 +1,12 @@
+"""
+WSGI entry point for production servers. With gunicorn:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is configured from the environment, see api.configureApp and
+database.py. Set CATALOG_SECRET_KEY so that every worker accepts the
+same session cookies.
+"""
+from api import configureApp
+
+app = configureApp()